@@ -1,8 +1,14 @@
 import torch
-import numpy as np
 import torch.nn as nn
-from torch.autograd import Variable
-from numpy.linalg import eigvals
+from collections import OrderedDict
+from utils import autocast
+try:
+  from torch.func import functional_call
+except ImportError:
+  try:
+    from torch.nn.utils.stateless import functional_call
+  except ImportError:
+    functional_call = None # torch < 1.12, see _backward_step_unrolled_inplace
 
 def _concat(xs):
   return torch.cat([x.view(-1) for x in xs])
@@ -11,87 +17,177 @@ def _concat(xs):
 class Architect(object):
 
   def __init__(self, model, model_momentum, model_weight_decay, arch_lr, 
-                arch_weight_decay, device):
+                arch_weight_decay, device, hessian_mode='finite_difference'):
     self.device = device
+    # Hessian-vector products of second-order (unrolled) steps: 'finite_difference' or 'exact' (double backward)
+    if hessian_mode == 'exact' and functional_call is None:
+      raise ValueError('Exact Hessian-vector products need torch >= 1.12 (installed: {})'.format(torch.__version__))
+    self.hessian_mode = hessian_mode
     self.network_momentum = model_momentum
     self.network_weight_decay = model_weight_decay
     self.model = model
     self.optimizer = torch.optim.Adam(self.model.arch_parameters(),
         lr=arch_lr, betas=(0.5, 0.999), weight_decay=arch_weight_decay)
-
-  def _compute_unrolled_model(self, input, target, eta, network_optimizer):
-    loss = self.model._loss(input, target)
-    theta = _concat(self.model.parameters()).data
-    try:
-      moment = _concat(network_optimizer.state[v]['momentum_buffer'] for v in self.model.parameters()).mul_(self.network_momentum)
-    except:
-      moment = torch.zeros_like(theta)
-    dtheta = _concat(torch.autograd.grad(loss, self.model.parameters())).data + self.network_weight_decay*theta
-    unrolled_model = self._construct_model_from_theta(theta.sub(eta, moment+dtheta))
-    return unrolled_model
-
-  def step(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer, unrolled):
+    # arch-gradients summed up over search batches until the next update (see step)
+    self.accumulated_grads = None
+    self.accumulated_batches = 0
+
+  def step(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer, unrolled, update=True):
+    """
+    Compute the arch-gradients on a search batch. With update=False they are only accumulated,
+    the next step with update=True averages all accumulated gradients and updates the alphas.
+    """
     self.optimizer.zero_grad()
     if unrolled:
         self._backward_step_unrolled(input_train, target_train, input_valid, target_valid, eta, network_optimizer)
     else:
         self._backward_step(input_valid, target_valid)
-    self.optimizer.step()
+    arch = self.model.arch_parameters()
+    grads = [torch.zeros_like(a) if a.grad is None else a.grad.clone() for a in arch]
+    if self.accumulated_grads is None:
+      self.accumulated_grads = grads
+    else:
+      self.accumulated_grads = [x + g for x, g in zip(self.accumulated_grads, grads)]
+    self.accumulated_batches += 1
+    if update:
+      for a, g in zip(arch, self.accumulated_grads):
+        a.grad = g / self.accumulated_batches
+      self.optimizer.step()
+      self.reset_accumulation()
+
+  def reset_accumulation(self):
+    self.accumulated_grads = None
+    self.accumulated_batches = 0
 
   def _backward_step(self, input_valid, target_valid):
-    loss = self.model._loss(input_valid, target_valid)
+    loss = self._loss(input_valid, target_valid)
     loss.backward()
 
+  def _loss(self, input, target):
+    # only the forward pass runs under autocast, the loss (and the backward pass) in float32
+    with autocast(self.device):
+      logits = self.model(input)
+    return self.model._criterion(logits.float(), target)
+
+  def _weights(self):
+    # network weights (all parameters except the alphas) by name
+    arch = set(id(a) for a in self.model.arch_parameters())
+    return OrderedDict((k, v) for k, v in self.model.named_parameters() if id(v) not in arch)
+
+  def _functional_loss(self, weights, input, target):
+    # loss of the model evaluated with the given weights, the live alphas and copies of the buffers
+    # (the batch-norm statistics of the model are not changed)
+    buffers = {k: v.clone() for k, v in self.model.named_buffers()}
+    with autocast(self.device):
+      logits = functional_call(self.model, {**buffers, **weights}, (input,))
+    return self.model._criterion(logits.float(), target)
+
+  def _compute_unrolled_weights(self, input, target, eta, network_optimizer):
+    """
+    One virtual SGD-step (momentum, weight-decay) of the network weights on the training batch,
+    w' = w - eta * (momentum * m + dL_train/dw + weight_decay * w), as new leaf tensors by name. The gradients
+    dL_train/dw are returned as well (with graph for exact Hessian-vector products).
+    """
+    weights = self._weights()
+    loss = self._loss(input, target)
+    # ops not sampled in this forward pass (sampled search) get no gradient
+    grads = torch.autograd.grad(loss, list(weights.values()), allow_unused=True, create_graph=self.hessian_mode == 'exact')
+    unrolled = OrderedDict()
+    with torch.no_grad():
+      for (k, w), g in zip(weights.items(), grads):
+        d = self.network_weight_decay * w if g is None else g + self.network_weight_decay * w
+        moment = network_optimizer.state.get(w, {}).get('momentum_buffer')
+        if moment is not None:
+          d = d + self.network_momentum * moment
+        unrolled[k] = (w - eta * d).requires_grad_()
+    return unrolled, grads
+
   def _backward_step_unrolled(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer):
-    unrolled_model = self._compute_unrolled_model(input_train, target_train, eta, network_optimizer)
-    unrolled_loss = unrolled_model._loss(input_valid, target_valid)
-
-    unrolled_loss.backward()
-    dalpha = [v.grad for v in unrolled_model.arch_parameters()]
-    vector = [v.grad.data for v in unrolled_model.parameters()]
-    implicit_grads = self._hessian_vector_product(vector, input_train, target_train)
-
-    for g, ig in zip(dalpha, implicit_grads):
-      g.data.sub_(eta, ig.data)
-
-    for v, g in zip(self.model.arch_parameters(), dalpha):
-      if v.grad is None:
-        v.grad = Variable(g.data)
-      else:
-        v.grad.data.copy_(g.data)
-
-  def _construct_model_from_theta(self, theta):
-    model_new = self.model.new()
-    model_dict = self.model.state_dict()
-
-    params, offset = {}, 0
-    for k, v in self.model.named_parameters():
-      v_length = np.prod(v.size())
-      params[k] = theta[offset: offset+v_length].view(v.size())
-      offset += v_length
-
-    assert offset == len(theta)
-    model_dict.update(params)
-    model_new.load_state_dict(model_dict)
-    return model_new.to(self.device)
+    if functional_call is None:
+      return self._backward_step_unrolled_inplace(input_train, target_train, input_valid, target_valid, eta, network_optimizer)
+    unrolled, train_grads = self._compute_unrolled_weights(input_train, target_train, eta, network_optimizer)
+    unrolled_loss = self._functional_loss(unrolled, input_valid, target_valid)
+
+    arch = self.model.arch_parameters()
+    grads = torch.autograd.grad(unrolled_loss, arch + list(unrolled.values()), allow_unused=True)
+    dalpha = [torch.zeros_like(a) if g is None else g for a, g in zip(arch, grads[:len(arch)])]
+    vector = [torch.zeros_like(w) if g is None else g for w, g in zip(unrolled.values(), grads[len(arch):])]
+    if self.hessian_mode == 'exact':
+      implicit_grads = self._exact_hessian_vector_product(vector, train_grads)
+    else:
+      implicit_grads = self._hessian_vector_product(vector, input_train, target_train)
+
+    for v, g, ig in zip(arch, dalpha, implicit_grads):
+      v.grad = g - eta * ig
 
   def _hessian_vector_product(self, vector, input, target, r=1e-2):
+    # d^2 L_train / (d alpha d w) * vector by central finite differences, the weights are not modified
     R = r / _concat(vector).norm()
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.add_(R, v)
-    loss = self.model._loss(input, target)
-    grads_p = torch.autograd.grad(loss, self.model.arch_parameters())
-
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.sub_(2*R, v)
-    loss = self.model._loss(input, target)
-    grads_n = torch.autograd.grad(loss, self.model.arch_parameters())
-
-    for p, v in zip(self.model.parameters(), vector):
-      p.data.add_(R, v)
+    weights = self._weights()
+    arch = self.model.arch_parameters()
+
+    cuda = [self.device] if torch.device(self.device).type == 'cuda' else []
+
+    def arch_grads(sign):
+      perturbed = {k: w.detach() + sign * R * v for (k, w), v in zip(weights.items(), vector)}
+      # both evaluations see the same random numbers (drop-path, sampled ops)
+      with torch.random.fork_rng(devices=cuda):
+        grads = torch.autograd.grad(self._functional_loss(perturbed, input, target), arch, allow_unused=True)
+      return [torch.zeros_like(a) if g is None else g for a, g in zip(arch, grads)]
+
+    return [(x-y).div_(2*R) for x, y in zip(arch_grads(1), arch_grads(-1))]
+
+  def _backward_step_unrolled_inplace(self, input_train, target_train, input_valid, target_valid, eta, network_optimizer):
+    # torch < 1.12 (no functional_call): the unrolled weights are loaded into a copy of the model and the
+    # Hessian-vector product is computed by perturbing the weights of the model in place
+    unrolled, _ = self._compute_unrolled_weights(input_train, target_train, eta, network_optimizer)
+    unrolled_model = self.model.new()
+    unrolled_model.load_state_dict({**self.model.state_dict(), **{k: w.detach() for k, w in unrolled.items()}})
+    unrolled_model = unrolled_model.to(self.device)
+    with autocast(self.device):
+      logits = unrolled_model(input_valid)
+    unrolled_loss = unrolled_model._criterion(logits.float(), target_valid)
+
+    arch = unrolled_model.arch_parameters()
+    params = dict(unrolled_model.named_parameters())
+    grads = torch.autograd.grad(unrolled_loss, arch + [params[k] for k in unrolled], allow_unused=True)
+    dalpha = [torch.zeros_like(a) if g is None else g for a, g in zip(arch, grads[:len(arch)])]
+    vector = [torch.zeros_like(params[k]) if g is None else g for k, g in zip(unrolled, grads[len(arch):])]
+    implicit_grads = self._inplace_hessian_vector_product(vector, input_train, target_train)
+
+    for v, g, ig in zip(self.model.arch_parameters(), dalpha, implicit_grads):
+      v.grad = g - eta * ig
+
+  def _inplace_hessian_vector_product(self, vector, input, target, r=1e-2):
+    R = r / _concat(vector).norm()
+    weights = list(self._weights().values())
+    arch = self.model.arch_parameters()
+
+    def arch_grads():
+      grads = torch.autograd.grad(self._loss(input, target), arch, allow_unused=True)
+      return [torch.zeros_like(a) if g is None else g for a, g in zip(arch, grads)]
+
+    with torch.no_grad():
+      for w, v in zip(weights, vector):
+        w.add_(v, alpha=R)
+    grads_p = arch_grads()
+    with torch.no_grad():
+      for w, v in zip(weights, vector):
+        w.sub_(v, alpha=2*R)
+    grads_n = arch_grads()
+    with torch.no_grad():
+      for w, v in zip(weights, vector):
+        w.add_(v, alpha=R)
 
     return [(x-y).div_(2*R) for x, y in zip(grads_p, grads_n)]
 
+  def _exact_hessian_vector_product(self, vector, train_grads):
+    # d^2 L_train / (d alpha d w) * vector by double backward through the training gradients
+    arch = self.model.arch_parameters()
+    dot = sum((g * v).sum() for g, v in zip(train_grads, vector) if g is not None)
+    grads = torch.autograd.grad(dot, arch, allow_unused=True)
+    return [torch.zeros_like(a) if g is None else g for a, g in zip(arch, grads)]
+
   def update_hyperparameters(self, hyperparams):
     for g in self.optimizer.param_groups:
       g['lr'] = hyperparams['arch_learning_rate']
@@ -100,59 +196,50 @@ class Architect(object):
     self.network_momentum = hyperparams['momentum']
     self.network_weight_decay = hyperparams['weight_decay']
 
-  def compute_Hw(self, input_valid, target_valid):
-      self.zero_grads(self.model.parameters())
-      self.zero_grads(self.model.arch_parameters())
-
-      loss = self.model._loss(input_valid, target_valid)
-      self.hessian = self._hessian(loss, self.model.arch_parameters())
-      return self.hessian
-  
-  def compute_eigenvalues(self):
-      #hessian = self.compute_Hw(input, target)
-      if self.hessian is None:
-          raise ValueError
-      return eigvals(self.hessian.cpu().data.numpy())
-  
-  def zero_grads(self, parameters):
-      for p in parameters:
-          if p.grad is not None:
-              p.grad.detach_()
-              p.grad.zero_()
-              #if p.grad.volatile:
-              #    p.grad.data.zero_()
-              #else:
-              #    data = p.grad.data
-              #    p.grad = Variable(data.new().resize_as_(data).zero_())
-
-  def _hessian(self, outputs, inputs, out=None, allow_unused=False,
-               create_graph=False):
-      #assert outputs.data.ndimension() == 1
-      if torch.is_tensor(inputs):
-          inputs = [inputs]
-      else:
-          inputs = list(inputs)
-      n = sum(p.numel() for p in inputs)
-      if out is None:
-          out = Variable(torch.zeros(n, n)).type_as(outputs)
-      ai = 0
-      for i, inp in enumerate(inputs):
-          [grad] = torch.autograd.grad(outputs, inp, create_graph=True,
-                                       allow_unused=allow_unused)
-          grad = grad.contiguous().view(-1) + self.weight_decay*inp.view(-1)
-          #grad = outputs[i].contiguous().view(-1)
-          for j in range(inp.numel()):
-              # print('(i, j): ', i, j)
-              if grad[j].requires_grad:
-                  row = self.gradient(grad[j], inputs[i:], retain_graph=True)[j:]
-              else:
-                  n = sum(x.numel() for x in inputs[i:]) - j
-                  row = Variable(torch.zeros(n)).type_as(grad[j])
-                  #row = grad[j].new_zeros(sum(x.numel() for x in inputs[i:]) - j)
-              out.data[ai, ai:].add_(row.clone().type_as(out).data)  # ai's row
-              if ai + 1 < n:
-                  out.data[ai + 1:, ai].add_(row.clone().type_as(out).data[1:])  # ai's column
-              del row
-              ai += 1
-          del grad
-      return out
\ No newline at end of file
+  def dominant_eigenvalues(self, input_valid, target_valid, k=1, steps=20):
+    """
+    Largest k eigenvalues of the Hessian of the loss on a batch w.r.t. the architecture parameters (plus the arch
+    weight-decay), estimated by Lanczos iteration on Hessian-vector products (double backward). Needs steps HVPs
+    instead of one autograd-call per entry of the Hessian.
+
+    Args:
+        input_valid (torch.Tensor): Inputs of the batch
+        target_valid (torch.Tensor): Targets of the batch
+        k (int, optional): Number of eigenvalues. Defaults to 1.
+        steps (int, optional): Number of Lanczos iterations (HVPs). Defaults to 20.
+
+    Returns:
+        list: k largest eigenvalues, descending
+    """
+    weight_decay = self.optimizer.param_groups[0]['weight_decay']
+    loss = self.model._loss(input_valid, target_valid)
+    grads = torch.autograd.grad(loss, self.model.arch_parameters(), create_graph=True, allow_unused=True)
+    # parameters not used in the forward pass (e.g. no normal cells) only contribute weight-decay eigenvalues
+    params = [p for p, g in zip(self.model.arch_parameters(), grads) if g is not None]
+    grads = _concat(g for g in grads if g is not None)
+    n = grads.numel()
+
+    def hvp(v):
+      return _concat(torch.autograd.grad(grads, params, grad_outputs=v, retain_graph=True)).detach() + weight_decay * v
+
+    q = torch.randn(n, dtype=grads.dtype, device=grads.device)
+    Q, alphas, betas = [q / q.norm()], [], []
+    for i in range(min(steps, n)):
+      w = hvp(Q[-1])
+      scale = w.norm()
+      alphas.append(torch.dot(w, Q[-1]))
+      # full re-orthogonalization against all Lanczos vectors (few, short vectors), twice for float32
+      basis = torch.stack(Q)
+      for _ in range(2):
+        w = w - basis.t() @ (basis @ w)
+      beta = w.norm()
+      # stop once the Krylov space is (numerically) invariant, otherwise noise yields spurious eigenvalues
+      if i == min(steps, n) - 1 or beta <= 1e-4 * scale:
+        break
+      betas.append(beta)
+      Q.append(w / beta)
+    T = torch.diag(torch.stack(alphas))
+    if betas:
+      off = torch.stack(betas)
+      T = T + torch.diag(off, 1) + torch.diag(off, -1)
+    return torch.linalg.eigvalsh(T).flip(0)[:k].tolist()
@@ -5,6 +5,11 @@ GAMMA = 6
 HYPERPARAM_CONFIG_NR = 240 # size of hyperparameter search space
 BATCH_SIZE = 64
 NAS_STEPS = 15
+EXPLORATION_TRIGGER = 'fixed' # 'fixed': explore every NAS_STEPS rounds, 'plateau': explore when progress stalls
+MIN_NAS_STEPS = 5 # min. number of training rounds between two exploration phases (plateau trigger)
+MAX_NAS_STEPS = 30 # max. number of training rounds before reward estimates are considered stale (plateau trigger)
+PLATEAU_DISCOUNT = 0.9 # discount of the baseline over round-over-round gains (plateau trigger)
+PLATEAU_TOLERANCE = 0.1 # progress stalled if last gain < PLATEAU_TOLERANCE * baseline (plateau trigger)
 
 # logging
 LOG_DIR = './runs/'
@@ -22,22 +27,91 @@ CELL_NR = 5 # number of cells the search space consists of (if search phase). El
 IN_CHANNELS = 3 # mumber of input-channels (e.g. 3 for rgb-images)
 OUT_CHANNELS = 48 # number of output-channels
 NODE_NR = 4 # number of nodes per cell
+PARTIAL_CHANNELS = 1 # PC-DARTS: only 1/PARTIAL_CHANNELS of the channels of an edge pass the candidate ops (1 = off), OUT_CHANNELS must be divisible by it
+FUSED_MIXED_OP = False # evaluate the mixed ops of the supernet with fused kernels (same results and state-dict)
+SEARCH_SAMPLING = False # GDAS-style search: clients train on SAMPLED_OPS Gumbel-softmax sampled ops per edge instead of all ops
+SAMPLED_OPS = 1 # number of ops sampled per edge and forward pass
+GUMBEL_TAU_MAX = 10.0 # temperature of the sampling in the first round, linearly annealed to GUMBEL_TAU_MIN in the last round
+GUMBEL_TAU_MIN = 0.1
 # fraud detection
 FRAUD_DETECTION_IN_DIM = 7
+FRAUD_FRACTION = 1.0 # fraction of the ccFraud rows to use (read from the columnar cache in ccFraud/cache/)
 NET_IN_DIMS = [7, 5, 3]
 NET_OUT_DIMS = [5, 3, 2]
+UNROLLED = False # second-order DARTS: arch-gradients through one virtual step of the network weights
+HESSIAN_MODE = 'finite_difference' # Hessian-vector products of second-order steps: 'finite_difference' or 'exact' (double backward)
+ARCH_EVERY = 1 # clients do an architecture step every ARCH_EVERY weight steps (0 = weights only)
+ARCH_START = 0.0 # fraction of a client's local steps after which architecture steps start
+ARCH_ACCUMULATE = False # accumulate arch-gradients of every weight step and update the alphas every ARCH_EVERY steps instead of skipping batches
+ARCH_IN_EXPLORATION = True # architecture steps in the rounds probing hyperparameter configurations (their weights are discarded)
 ES = False
 EV_MAX = 1.5
+ES_EIGENVALUES = 1 # number of dominant eigenvalues of the arch-Hessian estimated for the stability check
+ES_LANCZOS_STEPS = 20 # Lanczos iterations (Hessian-vector products) of the estimate
 
 PORT = '8065'
 GPUS = [2, 3] # GPUs to use
 SERVER_GPU = 4
 
+# local work
+ROUND_DEADLINE = 0 # seconds a client may spend in fit, local steps are chosen to meet it (0 = fixed number of epochs)
+MIN_LOCAL_STEPS = 1 # min. number of local steps per round (deadline mode)
+MAX_LOCAL_EPOCHS = 10 # max. number of passes over the local data per round (deadline mode)
+
+# client gain measurement
+PROBE_SIZE = 0 # size of the fixed stratified validation subset used for before/after losses, their mean over batches is reported (0 = whole validation set, summed losses as before)
+PROBE_BATCH_SIZE = 256 # batch size used for evaluating the probe set
+
+# server evaluation
+SERVER_EVAL_MODE = 'full' # 'full': evaluate on whole test-set, 'sampled': evaluate on stratified sample
+SERVER_EVAL_CI = 0.03 # targeted half-width of the confidence interval on test accuracy (sampled mode)
+SERVER_EVAL_CONFIDENCE = 0.95 # confidence level of the interval (sampled mode)
+SERVER_EVAL_FULL_EVERY = 10 # evaluate on whole test-set every N rounds and in the last round (sampled mode)
+
 DATA_SKEW = 0 # skew of labels. 0 = no skew, 1 only some clients hold some labels
 USE_WEIGHTED_SAMPLER = False # use a weighted random sampler to account for class imbalances 
+IMAGENET_RECORD_DIR = '../../../datasets/tiny-imagenet/records/' # imagenet is read from record shards in <dir>/train and <dir>/val if present (python records.py <image-folder> <dir>/train)
+BATCH_AUGMENT = False # imagenet: decode to uint8 and augment whole batches on the training device instead of per-sample PIL transforms in the workers
+
+# zero-cost pre-ranking of the search space (search stage)
+ZERO_COST_PROXY = None # 'naswot', 'synflow' or 'grad_norm': clients score the candidate ops in a first, training-free round. None = disabled
+ZERO_COST_BATCHES = 2 # number of local batches the proxy is computed on
+ZERO_COST_SAMPLES = 32 # number of sampled single-path architectures scored per client
+ZERO_COST_KEEP = 4 # number of ops kept per edge after pre-ranking (0 = no pruning)
+ZERO_COST_BIAS = 0.0 # scale of the shift of the alphas towards well-scored ops (0 = alphas unchanged)
+
+# progressive pruning of the supernet (search stage)
+PRUNE_ROUNDS = [] # training rounds after which the lowest-alpha ops of every edge are removed, e.g. [50, 100, 150, 200]
+PRUNE_OPS = 1 # number of ops removed per edge and pruning step
+PRUNE_MIN_OPS = 2 # never prune an edge below this number of ops
 
 # validation stage
 DROP_PATH_PROB = 0.2 # probability of dropping a path in cell, similar to dropout
 
+# runtime
+CHECKPOINT = None # activation checkpointing of the networks in training, recomputes activations in backward to save memory: None, 'cell' or 'op'
+COMPILE = False # compile the networks with torch.compile, needs torch >= 2.2 (not the pinned 1.9, falls back to eager execution where not possible)
+COMPILE_CACHE_DIR = './compile-cache/' # compiled graphs, reused after restarts
+PRECISION = 'fp32' # 'fp32' or 'bf16' (bfloat16 autocast of forward passes, weights and parameters sent stay float32)
+CHANNELS_LAST = False # channels-last (NHWC) memory format of conv-networks and input batches, faster depthwise-convs on CPU
+
+# data partitioning
+PARTITION_SCHEME = 'legacy' # 'legacy': partition_skewed + DATASET_INDS_FILE. Cached, vectorized alternatives: 'iid', 'label' (skew = DATA_SKEW), 'dirichlet', 'shards', 'quantity'
+PARTITION_ALPHA = 0.5 # concentration of the Dirichlet distribution ('dirichlet' and 'quantity' scheme)
+PARTITION_SHARDS = 2 # number of label-sorted shards per client ('shards' scheme)
+PARTITION_SEED = 42
+PARTITION_CACHE_DIR = './partitions/' # partitions are stored as offsets + indices .npy-files per (dataset, clients, scheme, param, seed)
+
 HYPERPARAM_FILE = f'./hyperparam-logs/search_DARTS_{DATASET}_{CLIENT_NR}_{DATA_SKEW}.csv'
-DATASET_INDS_FILE = './hyperparam-logs/indices.json'
\ No newline at end of file
+DATASET_INDS_FILE = './hyperparam-logs/indices.json'
+SHARED_DATA_DIR = None # directory (ideally on /dev/shm) for a single memory-mapped copy of the datasets shared by all processes of a host. None = every process loads its own copy
+SHARD_DIR = None # directory for pre-tensorized per-client partitions (.npy), e.g. f'./shards/{DATASET}_{CLIENT_NR}_{DATA_SKEW}/'. None = use datasets directly
+
+# cross-run knowledge base
+KNOWLEDGE_BASE_FILE = './hyperparam-logs/knowledge_base.json' # None disables recording and warm-starting
+WARM_START = False # seed config pool and reward estimates from nearest previous runs (runs are recorded regardless)
+WARM_START_RUNS = 3 # number of nearest previous runs used for warm-starting
+WARM_START_CONFIGS = 20 # max. number of configurations seeded into the pool
+WARM_START_PRIOR = 0.5 # scale of prior reward estimates relative to the stored ones
+WARM_START_GAMMA_SCALE = 0.5 # GAMMA is scaled by this factor in warm-started runs (shorter exploration)
+KNOWLEDGE_BASE_TOP_CONFIGS = 10 # number of best configurations stored per run
\ No newline at end of file
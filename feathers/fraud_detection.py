@@ -1,34 +1,152 @@
-from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
 from torch.utils.data import DataLoader, Dataset
 import torch
 import pandas as pd
 import numpy as np
+import fcntl
+import json
+import os
+import shutil
 
-class FraudDetectionData(Dataset):
+LABEL = 'fraudRisk'
+
+
+def build_cache(file, cache_dir, test_size=0.3, seed=42, chunksize=10**6):
+    """
+    One-time conversion of ccFraud.csv into a columnar cache: every column of the train- and test-split
+    is stored as a flat typed binary file ({split}_{column}.bin), meta.json holds dtypes, row counts and
+    mean/std of the features fitted on the train-split only. The CSV is streamed in chunks, rows are
+    assigned to the test-split with probability test_size.
+
+    Args:
+        file (str): Path to ccFraud.csv
+        cache_dir (str): Directory of the cache
+        test_size (float, optional): Fraction of rows in the test-split. Defaults to 0.3.
+        seed (int, optional): Seed of the split. Defaults to 42.
+        chunksize (int, optional): Number of rows read at once. Defaults to 10**6.
+    """
+    tmp_dir = '{}.tmp{}'.format(cache_dir.rstrip('/'), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    # dtypes are fixed up front: features are stored as float32 (exact for the integer-valued columns of ccFraud,
+    # later rows with fractional values are not truncated), labels as int8 (parsing fails loudly on non-integers)
+    columns = [c for c in pd.read_csv(file, nrows=0).columns if c != 'custID']
+    meta = {'rows': {'train': 0, 'test': 0}, 'features': [c for c in columns if c != LABEL]}
+    meta['dtypes'] = {c: 'float32' for c in meta['features']}
+    meta['dtypes'][LABEL] = 'int8'
+    files, stats = {}, np.zeros((2, len(meta['features'])))
+    for chunk in pd.read_csv(file, chunksize=chunksize, usecols=columns, dtype=meta['dtypes']):
+        in_test = rng.random(len(chunk)) < test_size
+        for split, rows in [('train', ~in_test), ('test', in_test)]:
+            part = chunk[rows]
+            meta['rows'][split] += len(part)
+            for column, dtype in meta['dtypes'].items():
+                if (split, column) not in files:
+                    files[(split, column)] = open(os.path.join(tmp_dir, '{}_{}.bin'.format(split, column)), 'wb')
+                files[(split, column)].write(part[column].to_numpy().astype(dtype).tobytes())
+        train_features = chunk.loc[~in_test, meta['features']].to_numpy(dtype=np.float64)
+        stats += [train_features.sum(axis=0), (train_features ** 2).sum(axis=0)]
+    for f in files.values():
+        f.close()
+    mean = stats[0] / meta['rows']['train']
+    meta['mean'] = mean.tolist()
+    meta['std'] = np.sqrt(np.maximum(stats[1] / meta['rows']['train'] - mean ** 2, 0)).tolist()
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir) # built concurrently by another process
+
+def ensure_cache(file, cache_dir):
+    """
+    Build the cache unless it exists. Processes starting on a cold cache wait for the first one
+    to build it instead of all streaming the CSV.
+    """
+    if os.path.exists(os.path.join(cache_dir, 'meta.json')):
+        return
+    with open(cache_dir.rstrip('/') + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(os.path.join(cache_dir, 'meta.json')):
+            build_cache(file, cache_dir)
 
-    def __init__(self, file, train) -> None:
+def load_column(cache_dir, meta, split, column):
+    return np.memmap(os.path.join(cache_dir, '{}_{}.bin'.format(split, column)), dtype=meta['dtypes'][column],
+                     mode='r', shape=(meta['rows'][split],))
+
+class TabularData(Dataset):
+
+    def __init__(self, X, y) -> None:
+        """
+        Rows of a tabular dataset held in memory as tensors (e.g. the partition of a client).
+        """
         super().__init__()
-        data = pd.read_csv(file + 'ccFraud.csv')
-        data = data.drop(columns=['custID'])
-        np.random.seed(0) # ensure deterministic behavior
-        subsamples = np.random.randint(0, len(data), size=int(0.01*len(data)))
-        data = data.iloc[subsamples, :]
-        y = data['fraudRisk'].to_numpy()
-        X = data.drop(columns=['fraudRisk']).to_numpy()
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=42)
-        if train:
-            X, y = X_train, y_train
-        else:
-            X, y = X_test, y_test
-        scaler = StandardScaler()
-        X = scaler.fit_transform(X)
-        self.y = torch.from_numpy(y).long()
-        self.X = torch.from_numpy(X).float()
+        self.X = torch.as_tensor(X)
+        self.y = torch.as_tensor(y)
 
     def __len__(self):
         return self.X.shape[0]
 
     def __getitem__(self, index):
-        x, y = self.X[index], self.y[index]
-        return x, y
\ No newline at end of file
+        return self.X[index], self.y[index]
+
+class FraudDetectionData(Dataset):
+
+    def __init__(self, file, train, fraction=1.0, features=None) -> None:
+        """
+        ccFraud-dataset read from the columnar cache in file + 'cache/' (built from ccFraud.csv on first use).
+        The feature-columns stay memory-mapped, only the labels are held in memory. Rows are gathered
+        (and standardized with the statistics of the train-split) when they are accessed, see gather and subset.
+
+        Args:
+            file (str): Directory holding ccFraud.csv
+            train (bool): Train- or test-split
+            fraction (float, optional): Fraction of rows to use, drawn at random with a fixed seed. Defaults to 1.0.
+            features (list, optional): Feature-columns to use. Defaults to None (all).
+        """
+        super().__init__()
+        cache_dir = file + 'cache/'
+        ensure_cache(file + 'ccFraud.csv', cache_dir)
+        with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        split = 'train' if train else 'test'
+        features = meta['features'] if features is None else features
+        n_rows = meta['rows'][split]
+        self.rows = np.arange(n_rows)
+        if fraction < 1.0:
+            self.rows = np.sort(np.random.default_rng(0).choice(n_rows, size=int(fraction * n_rows), replace=False))
+        self.columns = [load_column(cache_dir, meta, split, column) for column in features]
+        inds = [meta['features'].index(column) for column in features]
+        self.mean = np.array([meta['mean'][j] for j in inds], dtype=np.float32)
+        self.std = np.array([max(meta['std'][j], 1e-12) for j in inds], dtype=np.float32)
+        self.y = torch.from_numpy(load_column(cache_dir, meta, split, LABEL)[self.rows].astype(np.int64))
+
+    def gather(self, indices=None):
+        """
+        Read the standardized features of the given rows (all if None) from the memory-mapped columns.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: Features (float32) and labels of the rows
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        rows = self.rows[indices]
+        X = np.empty((len(rows), len(self.columns)), dtype=np.float32)
+        for i, column in enumerate(self.columns):
+            X[:, i] = column[rows]
+        X -= self.mean
+        X /= self.std
+        return X, self.y.numpy()[indices]
+
+    def subset(self, indices):
+        return TabularData(*self.gather(indices))
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getitem__(self, index):
+        x, y = self.gather([index])
+        return torch.from_numpy(x[0]), self.y[index]
+
+    def __getitems__(self, indices):
+        # batched access of the DataLoader, one gather per column instead of one per sample
+        X, _ = self.gather(indices)
+        return [(torch.from_numpy(x), self.y[i]) for x, i in zip(X, indices)]
@@ -8,16 +8,17 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, WeightedRandomSampler
 from torch.autograd import Variable
 import numpy as np
-from utils import get_dataset_loder
+from utils import get_dataset_loder, load_client_shards, get_targets, class_weights, make_loader, device_loader, EndlessLoader, prune_optimizer, weight_parameters, autocast, compile_model, memory_format, build_probe_set, ThroughputMeter
 from rtpt import RTPT
 import config
 from hyperparameters import Hyperparameters
 from tensorboardX import SummaryWriter
 from datetime import datetime as dt
 import argparse
-from model_search import Network, TabularNetwork
+import time
+from model_search import Network, TabularNetwork, load_arch_masks
 from architect import Architect
-from copy import deepcopy
+from zero_cost import score_ops
 
 warnings.filterwarnings("ignore", category=UserWarning)
 EPOCHS = 1
@@ -33,7 +34,9 @@ def _test(net, testloader, device):
             #feats = feats.type(torch.FloatTensor)
             #labels = labels.type(torch.LongTensor)
             feats, labels = feats.to(device), labels.to(device)
-            preds = net(feats)
+            with autocast(device):
+                preds = net(feats)
+            preds = preds.float()
             if config.CLASSES > 2:
                 loss += criterion(preds, labels).item()
                 _, predicted = torch.max(preds.data, 1)
@@ -49,36 +52,82 @@ def _test(net, testloader, device):
     accuracy = correct / total
     return loss, accuracy
 
-def train(train_queue, valid_queue, model, architect, criterion, optimizer, lr, device):
+class ArchSchedule:
+
+  def __init__(self, every=1, start=0.0, max_steps=None, train_start=None, stop_at=None):
+    """
+    Cadence of the architecture steps within one fit: an architecture step precedes every every-th weight step,
+    starting after a fraction start of the local training (of max_steps steps, or, with a deadline, of the time
+    between train_start and stop_at, since max_steps is only an upper bound there); every=0 trains the weights only.
+    With ARCH_ACCUMULATE the arch-gradients of all weight steps from then on are accumulated instead
+    and the alphas are updated every every-th step.
+    """
+    self.every = every
+    self.start_step = int(start * max_steps) if stop_at is None else None
+    self.start_time = train_start + start * (stop_at - train_start) if stop_at is not None else None
+    self.first = None # fit-step of the first architecture step
+
+  def __call__(self, step):
+    """
+    Returns:
+        Optional[bool]: None if no architecture step precedes this weight step, else whether the alphas are updated
+    """
+    if self.every <= 0:
+      return None
+    if self.first is None:
+      started = time.time() >= self.start_time if self.start_step is None else step >= self.start_step
+      if not started:
+        return None
+      self.first = step
+    k = step - self.first
+    if config.ARCH_ACCUMULATE:
+      return (k + 1) % self.every == 0
+    return True if k % self.every == 0 else None
+
+def train(train_queue, valid_queue, model, architect, criterion, optimizer, lr, device, max_steps=None, stop_at=None,
+          arch_schedule=None, first_step=0):
+  """
+  Local search training, architecture steps (on batches of the search queue) are done according to arch_schedule
+  (before every weight step if None). first_step is the step of the fit the epoch starts at.
+  """
+  steps = 0
   for step, (input, target) in enumerate(train_queue):
+    if (max_steps is not None and steps >= max_steps) or (stop_at is not None and steps > 0 and time.time() >= stop_at):
+        break
     model.train()
 
     input = input.to(device, non_blocking=True)
     target = target.to(device, non_blocking=True)
-
-    # get a random minibatch from the search queue with replacement
-    input_search, target_search = next(iter(valid_queue))
-    input_search = input_search.to(device, non_blocking=True)
-    target_search = target_search.to(device, non_blocking=True)
-
     if config.CLASSES == 2:
         target = target.float()
-        target_search = target_search.float()
 
-    architect.step(input, target, input_search, target_search, lr, optimizer, unrolled=False)
+    # weight-only steps neither draw a search batch nor run the architect
+    update = True if arch_schedule is None else arch_schedule(first_step + steps)
+    if update is not None:
+        # get the next minibatch from the (endless, reshuffling) search queue
+        input_search, target_search = next(valid_queue)
+        input_search = input_search.to(device, non_blocking=True)
+        target_search = target_search.to(device, non_blocking=True)
+        if config.CLASSES == 2:
+            target_search = target_search.float()
+
+        architect.step(input, target, input_search, target_search, lr, optimizer, unrolled=config.UNROLLED, update=update)
 
     optimizer.zero_grad()
-    logits = model(input)
-    loss = criterion(logits, target)
+    with autocast(device):
+        logits = model(input)
+    loss = criterion(logits.float(), target)
 
     loss.backward()
-    nn.utils.clip_grad_norm(model.parameters(), 5.)
+    nn.utils.clip_grad_norm(weight_parameters(model), 5.)
     optimizer.step()
 
+    steps += 1
+
     if step % 50 == 0:
         print("Step %03d" % step)
   
-  return model
+  return model, steps
 
 # #############################################################################
 # 2. Federation of the pipeline with Flower
@@ -88,8 +137,13 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
     """Create model, load data, define Flower client, start Flower client."""
 
     # Load data
-    data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, config.DATA_SKEW)
-    train_data, test_data = data_loader.load_client_data(client_id)
+    train_augment, val_augment = None, None
+    if config.SHARD_DIR is not None:
+        train_data, test_data = load_client_shards(config.SHARD_DIR, client_id)
+    else:
+        data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, config.DATA_SKEW)
+        train_data, test_data = data_loader.load_client_data(client_id)
+        train_augment, val_augment = data_loader.train_augment, data_loader.val_augment
     date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
     # writer = SummaryWriter("./runs/Client_{}".format(date))
     rtpt = RTPT('JS', 'FEATHERS_Client', EPOCHS)
@@ -109,16 +163,31 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
                 self.model = TabularNetwork(config.NET_IN_DIMS, config.NET_OUT_DIMS, config.CLASSES, self.criterion, device)
             else:
                 self.model = Network(out_channels, classes, cell_nr, self.criterion, device, 
-                                     in_channels=input_channels, steps=config.NODE_NR, drop_path_prob=config.DROP_PATH_PROB)
-            self.model = self.model.to(device)
-            self.optimizer = torch.optim.SGD(self.model.parameters(), 0.01, 0.9, 3e-4)
+                                     in_channels=input_channels, steps=config.NODE_NR, drop_path_prob=config.DROP_PATH_PROB,
+                                     partial_channels=config.PARTIAL_CHANNELS, fused=config.FUSED_MIXED_OP,
+                                     sampled_ops=config.SAMPLED_OPS, checkpoint=config.CHECKPOINT)
+            self.model = compile_model(self.model.to(device, memory_format=memory_format()))
+            self.optimizer = torch.optim.SGD(weight_parameters(self.model), 0.01, 0.9, 3e-4)
             sampler = self._get_sampler(train_data) if config.USE_WEIGHTED_SAMPLER else None
-            self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, sampler=sampler)
-            self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
-            self.architect = Architect(self.model, 0.9, 3e-4, 3e-4, 1e-3, device)
+            self.train_loader = device_loader(make_loader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, sampler=sampler,
+                                                          persistent_workers=True), device, train_augment)
+            self.val_loader = device_loader(make_loader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2,
+                                                        persistent_workers=True), device, val_augment)
+            # endless, reshuffling stream of architecture-search batches, workers are started once
+            search_loader = make_loader(test_data, config.BATCH_SIZE, shuffle=True, pin_memory=True, num_workers=2, persistent_workers=True)
+            self.search_queue = iter(device_loader(EndlessLoader(search_loader), device, val_augment))
+            self.es_batch = None
+            if config.PROBE_SIZE > 0:
+                self.probe = build_probe_set(test_data, config.PROBE_SIZE, seed=client_id)
+                self.probe_loader = device_loader(make_loader(self.probe, config.PROBE_BATCH_SIZE), device, val_augment)
+            else:
+                self.probe, self.probe_loader = test_data, self.val_loader
+            self.architect = Architect(self.model, 0.9, 3e-4, 3e-4, 1e-3, device, config.HESSIAN_MODE)
+            self.throughput = ThroughputMeter()
 
         def get_parameters(self):
-            return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
+            # canonical (contiguous) layout, independent of the local memory format
+            return [val.cpu().contiguous().numpy() for _, val in self.model.state_dict().items()]
 
         def set_parameters_train(self, parameters, config):
             # obtain hyperparams and distribution
@@ -129,52 +198,110 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             # remove hyperparameter distribution from parameter list
             parameters = parameters[:-1]
             
+            self._sync_search_space(parameters)
             params_dict = zip(self.model.state_dict().keys(), parameters)
             state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
 
+        def _sync_search_space(self, parameters):
+            # ops pruned by the server are removed locally, their weights are neither trained nor sent anymore
+            load_arch_masks(self.model, parameters)
+            prune_optimizer(self.optimizer, self.model)
+
         def set_parameters_evaluate(self, parameters):
+            self._sync_search_space(parameters)
             params_dict = zip(self.model.state_dict().keys(), parameters)
             state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
             self.model.load_state_dict(state_dict, strict=True)
 
-        def fit(self, parameters, config):
-            self.set_parameters_train(parameters, config)
-            before_loss, _ = _test(self.model, self.val_loader, device)
+        def fit(self, parameters, cfg):
+            if cfg.get('zero_cost', 0):
+                return self._zero_cost_fit(parameters, cfg)
+            fit_start = time.time()
+            self.set_parameters_train(parameters, cfg)
+            if hasattr(self.model, 'tau'):
+                self.model.tau = cfg.get('tau')
+            # mean loss per probe batch, s.t. gains do not scale with the size of the probe set (the whole-set losses stay summed as before)
+            before_loss, _ = _test(self.model, self.probe_loader, device)
+            if config.PROBE_SIZE > 0:
+                before_loss /= len(self.probe_loader)
             if config.ES:
-                model_copy = deepcopy(self.model).cpu()
-            for e in range(EPOCHS):
+                rollback = {k: v.clone() for k, v in self.model.state_dict().items()}
+            max_steps, stop_at = self._local_work(cfg.get('deadline', 0), fit_start)
+            # alphas are replaced by the aggregated ones, gradients accumulated in the last round are stale
+            self.architect.reset_accumulation()
+            steps, e = 0, 0
+            train_start = time.time()
+            arch_schedule = ArchSchedule(cfg.get('arch_every', 1), cfg.get('arch_start', 0.0), max_steps, train_start, stop_at)
+            while steps < max_steps and (stop_at is None or steps < config.MIN_LOCAL_STEPS or time.time() < stop_at):
                 rtpt.step()
                 self.epoch += 1
                 if config.DROP_PATH_PROB != 0:
                     self.model.drop_path_prob = config.DROP_PATH_PROB * e / ((EPOCHS * config.ROUNDS) - 1)
-                self.model = train(self.train_loader, self.val_loader, self.model,
+                self.model, epoch_steps = train(self.train_loader, self.search_queue, self.model,
                                                  self.architect, self.criterion, self.optimizer, 
-                                                 self.hyperparam_config['learning_rate'], device)
+                                                 self.hyperparam_config['learning_rate'], device, max_steps - steps, stop_at,
+                                                 arch_schedule, steps)
+                steps += epoch_steps
+                e += 1
+            self.throughput.update(time.time() - train_start, steps)
             if config.ES:
-                _data_loader = deepcopy(self.train_loader)
-                x, y = next(iter(_data_loader))
-                x, y = x.to(device), y.to(device)
-                _ = self.architect.compute_Hw(x, y)
-                ev = max(self.architect.compute_eigenvalues())
+                if self.es_batch is None:
+                    # fixed batch for the stability check, taken once
+                    self.es_batch = next(iter(self.train_loader))
+                x, y = self.es_batch
+                if config.CLASSES == 2:
+                    y = y.float()
+                ev = max(self.architect.dominant_eigenvalues(x, y, config.ES_EIGENVALUES, config.ES_LANCZOS_STEPS))
                 if ev >= config.EV_MAX:
                     # roll back model
-                    self.model = model_copy.to(device)
+                    self.model.load_state_dict(rollback)
 
-            after_loss, _ = _test(self.model, self.val_loader, device)
+            after_loss, _ = _test(self.model, self.probe_loader, device)
+            if config.PROBE_SIZE > 0:
+                after_loss /= len(self.probe_loader)
             model_params = self.get_parameters()
-            return model_params, len(train_data), {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss)}
+            # with a deadline, updates are weighted by the number of samples actually processed
+            num_examples = len(train_data) if stop_at is None else steps * config.BATCH_SIZE
+            return model_params, num_examples, {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss), 
+                                                'probe': len(self.probe), 'steps': steps}
+
+        def _zero_cost_fit(self, parameters, cfg):
+            # pre-search round: score the candidate operations on a few local batches without training
+            self.set_parameters_train(parameters, cfg)
+            batches = []
+            for x, y in self.train_loader:
+                batches.append((x, y.float() if config.CLASSES == 2 else y))
+                if len(batches) >= config.ZERO_COST_BATCHES:
+                    break
+            scores = score_ops(self.model, batches, config.ZERO_COST_PROXY, config.ZERO_COST_SAMPLES, seed=client_id)
+            scores = np.concatenate([s.ravel() for s in scores]).astype(np.float32)
+            return self.get_parameters(), len(train_data), {'hidx': int(self.hidx), 'zero_cost': scores.tobytes()}
 
         def evaluate(self, parameters, config):
             self.set_parameters_evaluate(parameters)
             loss, accuracy = _test(self.model, self.val_loader, device)
             return float(loss), len(test_data), {"accuracy": float(accuracy)}
 
+        def _local_work(self, deadline, fit_start):
+            """
+            Choose the number of local steps s.t. fit finishes within deadline seconds, based on the measured
+            step throughput. Time already spent in fit is accounted for twice, since the after-loss still has to be computed.
+
+            Returns:
+                Tuple[int, float]: Max. number of local steps and time at which training is stopped (None without deadline)
+            """
+            if deadline <= 0:
+                return EPOCHS * len(self.train_loader), None
+            budget = deadline - 2 * (time.time() - fit_start)
+            max_steps = self.throughput.steps_within(budget, config.MIN_LOCAL_STEPS, config.MAX_LOCAL_EPOCHS * len(self.train_loader))
+            return max_steps, time.time() + budget
+
         def set_current_hyperparameter_config(self, hyperparam, idx):
             self.hyperparam_config = hyperparam
             self.hidx = idx
             if self.optimizer is None:
-                self.optimizer = torch.optim.SGD(self.model.parameters(), self.hyperparam_config['learning_rate'], 
+                self.optimizer = torch.optim.SGD(weight_parameters(self.model), self.hyperparam_config['learning_rate'], 
                                                 momentum=self.hyperparam_config['momentum'], weight_decay=self.hyperparam_config['weight_decay'])
             else:
                 for g in self.optimizer.param_groups:
@@ -186,10 +313,7 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             self.architect.update_hyperparameters(hyperparam)
 
         def _get_sampler(self, training_data):
-            targets = training_data.dataset.y[training_data.indices]
-            class_count = torch.tensor([len(targets[targets == t]) for t in torch.unique(targets)])
-            weight = 1 / class_count
-            samples_weight = torch.tensor([weight[t] for t in targets]).double()
+            samples_weight = class_weights(get_targets(training_data))
             sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
             return sampler
             
@@ -7,13 +7,14 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, WeightedRandomSampler
 from torch.autograd import Variable
 import numpy as np
-from utils import get_dataset_loder, CrossEntropyLabelSmooth
+from utils import get_dataset_loder, load_client_shards, get_targets, class_weights, make_loader, device_loader, build_probe_set, CrossEntropyLabelSmooth, ThroughputMeter, autocast, compile_model, memory_format
 from rtpt import RTPT
 import config
 from hyperparameters import Hyperparameters
 from tensorboardX import SummaryWriter
 from datetime import datetime as dt
 import argparse
+import time
 from model import NetworkCIFAR, NetworkImageNet, NetworkTabular
 from genotypes import GENOTYPE
 
@@ -31,7 +32,9 @@ def _test(net, testloader, device):
             #feats = feats.type(torch.FloatTensor)
             #labels = labels.type(torch.LongTensor)
             feats, labels = feats.to(device), labels.to(device)
-            preds, _ = net(feats)
+            with autocast(device):
+                preds, _ = net(feats)
+            preds = preds.float()
             if config.CLASSES > 2:
                 loss += criterion(preds, labels).item()
                 _, predicted = torch.max(preds.data, 1)
@@ -47,9 +50,11 @@ def _test(net, testloader, device):
     accuracy = correct / total
     return loss, accuracy
 
-def train(train_queue, model, criterion, optimizer, device):
-
+def train(train_queue, model, criterion, optimizer, device, max_steps=None, stop_at=None):
+  steps = 0
   for step, (input, target) in enumerate(train_queue):
+    if (max_steps is not None and steps >= max_steps) or (stop_at is not None and steps > 0 and time.time() >= stop_at):
+        break
     model.train()
 
     input = input.to(device)
@@ -60,17 +65,19 @@ def train(train_queue, model, criterion, optimizer, device):
         target = target.float()
 
     optimizer.zero_grad()
-    logits, _ = model(input)
-    loss = criterion(logits, target)
+    with autocast(device):
+        logits, _ = model(input)
+    loss = criterion(logits.float(), target)
 
     loss.backward()
     nn.utils.clip_grad_norm(model.parameters(), 5.)
     optimizer.step()
+    steps += 1
 
     if step % 50 == 0:
         print(f'Step Acc Loss {step} {loss.item()}')
   
-  return model
+  return model, steps
 
 # #############################################################################
 # 2. Federation of the pipeline with Flower
@@ -80,8 +87,13 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
     """Create model, load data, define Flower client, start Flower client."""
 
     # Load data
-    data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, skew=config.DATA_SKEW)
-    train_data, test_data = data_loader.load_client_data(client_id)
+    train_augment, val_augment = None, None
+    if config.SHARD_DIR is not None:
+        train_data, test_data = load_client_shards(config.SHARD_DIR, client_id)
+    else:
+        data_loader = get_dataset_loder(dataset, num_clients, config.DATASET_INDS_FILE, skew=config.DATA_SKEW)
+        train_data, test_data = data_loader.load_client_data(client_id)
+        train_augment, val_augment = data_loader.train_augment, data_loader.val_augment
     date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
     writer = SummaryWriter("./runs/Client_val_{}".format(date))
     rtpt = RTPT('JS', 'FEATHERS_Client', EPOCHS)
@@ -102,23 +114,33 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             else:
                 self.criterion_train = self.criterion
             if config.DATASET == 'cifar10' or config.DATASET == 'fmnist':
-                self.model = NetworkCIFAR(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device, in_channels=input_channels)
+                self.model = NetworkCIFAR(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device, in_channels=input_channels,
+                                          checkpoint=config.CHECKPOINT)
             elif config.DATASET == 'imagenet':
-                self.model = NetworkImageNet(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device)
+                self.model = NetworkImageNet(out_channels, classes, cell_nr, False, genotype=GENOTYPE, device=device, checkpoint=config.CHECKPOINT)
             elif config.DATASET == 'fraud':
                 self.model = NetworkTabular(config.NET_IN_DIMS, config.NET_OUT_DIMS, config.CLASSES, GENOTYPE, device=device)
-            self.model = self.model.to(device)
+            self.model = compile_model(self.model.to(device, memory_format=memory_format()))
             self.optimizer = torch.optim.SGD(self.model.parameters(), 0.1, 0.9, 3e-5)
             sampler = self._get_sampler(train_data) if config.USE_WEIGHTED_SAMPLER else None
             if sampler is not None:
-                self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, sampler=sampler)
+                self.train_loader = make_loader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, sampler=sampler, persistent_workers=True)
+            else:
+                self.train_loader = make_loader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, shuffle=True, persistent_workers=True)
+            self.train_loader = device_loader(self.train_loader, device, train_augment)
+            self.val_loader = device_loader(make_loader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, shuffle=True,
+                                                        persistent_workers=True), device, val_augment)
+            if config.PROBE_SIZE > 0:
+                self.probe = build_probe_set(test_data, config.PROBE_SIZE, seed=client_id)
+                self.probe_loader = device_loader(make_loader(self.probe, config.PROBE_BATCH_SIZE), device, val_augment)
             else:
-                self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, shuffle=True)
-            self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, shuffle=True)
+                self.probe, self.probe_loader = test_data, self.val_loader
             self.hyperparam_config = None
+            self.throughput = ThroughputMeter()
 
         def get_parameters(self):
-            return [val.cpu().numpy() for _, val in self.model.state_dict().items()]
+            # canonical (contiguous) layout, independent of the local memory format
+            return [val.cpu().contiguous().numpy() for _, val in self.model.state_dict().items()]
 
         def set_parameters_train(self, parameters, config):
             # obtain hyperparams and distribution
@@ -139,25 +161,54 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
             self.model.load_state_dict(state_dict, strict=True)
 
         def fit(self, parameters, cfg):
+            fit_start = time.time()
             self.set_parameters_train(parameters, cfg)
             # test without dropout
             self.model.drop_path_prob = 0
-            before_loss, _ = _test(self.model, self.val_loader, device)
+            # mean loss per probe batch, s.t. gains do not scale with the size of the probe set (the whole-set losses stay summed as before)
+            before_loss, _ = _test(self.model, self.probe_loader, device)
+            if config.PROBE_SIZE > 0:
+                before_loss /= len(self.probe_loader)
             self.model.drop_path_prob = self.hyperparam_config['dropout']
-            for e in range(EPOCHS):
+            max_steps, stop_at = self._local_work(cfg.get('deadline', 0), fit_start)
+            steps = 0
+            train_start = time.time()
+            while steps < max_steps and (stop_at is None or steps < config.MIN_LOCAL_STEPS or time.time() < stop_at):
                 rtpt.step()
                 self.epoch += 1
-                self.model = train(self.train_loader, self.model, self.criterion_train, self.optimizer, device)
+                self.model, epoch_steps = train(self.train_loader, self.model, self.criterion_train, self.optimizer, device, 
+                                                max_steps - steps, stop_at)
+                steps += epoch_steps
+            self.throughput.update(time.time() - train_start, steps)
             self.model.drop_path_prob = 0
-            after_loss, _ = _test(self.model, self.val_loader, device)
+            after_loss, _ = _test(self.model, self.probe_loader, device)
+            if config.PROBE_SIZE > 0:
+                after_loss /= len(self.probe_loader)
             model_params = self.get_parameters()
-            return model_params, len(train_data), {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss)}
+            # with a deadline, updates are weighted by the number of samples actually processed
+            num_examples = len(train_data) if stop_at is None else steps * config.BATCH_SIZE
+            return model_params, num_examples, {'hidx': int(self.hidx), 'before': float(before_loss), 'after': float(after_loss), 
+                                                'probe': len(self.probe), 'steps': steps}
 
         def evaluate(self, parameters, config):
             self.set_parameters_evaluate(parameters)
             loss, accuracy = _test(self.model, self.val_loader, device)
             return float(loss), len(test_data), {"accuracy": float(accuracy)}
 
+        def _local_work(self, deadline, fit_start):
+            """
+            Choose the number of local steps s.t. fit finishes within deadline seconds, based on the measured
+            step throughput. Time already spent in fit is accounted for twice, since the after-loss still has to be computed.
+
+            Returns:
+                Tuple[int, float]: Max. number of local steps and time at which training is stopped (None without deadline)
+            """
+            if deadline <= 0:
+                return EPOCHS * len(self.train_loader), None
+            budget = deadline - 2 * (time.time() - fit_start)
+            max_steps = self.throughput.steps_within(budget, config.MIN_LOCAL_STEPS, config.MAX_LOCAL_EPOCHS * len(self.train_loader))
+            return max_steps, time.time() + budget
+
         def set_current_hyperparameter_config(self, hyperparam, idx):
             self.hyperparam_config = hyperparam
             self.hidx = idx
@@ -167,10 +218,7 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
                 g['weight_decay'] = self.hyperparam_config['weight_decay']
 
         def _get_sampler(self, training_data):
-            targets = training_data.dataset.y[training_data.indices]
-            class_count = torch.tensor([len(targets[targets == t]) for t in torch.unique(targets)])
-            weight = 1 / class_count
-            samples_weight = torch.tensor([weight[t] for t in targets]).double()
+            samples_weight = class_weights(get_targets(training_data))
             sampler = WeightedRandomSampler(samples_weight, len(samples_weight))
             return sampler
             
@@ -8,15 +8,19 @@ from scipy.special import softmax
 from scipy.stats import entropy
 from sklearn.metrics import f1_score
 from helpers import ProtobufNumpyArray, log_model_weights, log_hyper_config, log_hyper_params
-from utils import discounted_mean, get_dataset_loder
+from augmentation import AugmentedLoader
+from utils import autocast, discounted_mean, make_loader, get_dataset_loder, export_shards, load_server_shards, get_targets, stratified_sample, sample_size_for_ci, accuracy_ci
 from collections import OrderedDict
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tensorboardX import SummaryWriter
 from rtpt import RTPT
 from datetime import datetime as dt
 import config
 from hyperparameters import Hyperparameters
+from knowledge_base import KnowledgeBase
+from zero_cost import apply_scores
+from model_search import load_arch_masks
 import logging
 import os
 import sys
@@ -34,10 +38,12 @@ def _test(net, testloader, writer, round, stage='search'):
             #feats = feats.type(torch.FloatTensor)
             #labels = labels.type(torch.LongTensor)
             feats, labels = feats.to(DEVICE), labels.to(DEVICE)
-            if stage == 'search':
-                preds = net(feats)
-            else:
-                preds, preds_aux = net(feats)
+            with autocast(DEVICE):
+                if stage == 'search':
+                    preds = net(feats)
+                else:
+                    preds, preds_aux = net(feats)
+            preds = preds.float()
             writer.add_histogram('logits', preds, round)
             if config.CLASSES > 2:
                 loss += criterion(preds, labels).item()
@@ -78,25 +84,43 @@ class HANFStrategy(fl.server.strategy.FedAvg):
                                 around those for which p(configuration) > epsilon holds. Smaller beta leads to a more wide-spread distribution. Defaults to 1.
         """
         super().__init__(fraction_fit=fraction_fit, fraction_eval=fraction_eval, **args)
+        if self.on_fit_config_fn is None:
+            self.on_fit_config_fn = self.fit_config
         self.hyperparams = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
-        self.hyperparams.save(config.HYPERPARAM_FILE)
         self.date = dt.strftime(dt.now(), '%Y:%m:%d:%H:%M:%S')
+        # warm-start pool and reward estimates from previous runs in a similar setting
+        self.knowledge_base = KnowledgeBase(config.KNOWLEDGE_BASE_FILE) if config.KNOWLEDGE_BASE_FILE is not None else None
+        self.knowledge_base_key = self._knowledge_base_key(initial_net, stage)
+        prior_rewards = np.zeros(len(self.hyperparams))
+        if self.knowledge_base is not None and config.WARM_START:
+            prior_rewards = self.knowledge_base.warm_start(self.knowledge_base_key, self.hyperparams, config.WARM_START_RUNS,
+                                                           config.WARM_START_CONFIGS, config.WARM_START_PRIOR, exclude=self.date)
+        self.hyperparams.save(config.HYPERPARAM_FILE)
         log_hyper_params(self.hyperparams.to_dict(), 'hyperparam-logs/hyperparameters_{}.json'.format(self.date))
         self.use_gain_avg = use_gain_avg
         self.net = initial_net
         self.net.to(DEVICE)
-        initial_params = [param.cpu().detach().numpy() for _, param in self.net.state_dict().items()]
+        initial_params = [param.cpu().detach().contiguous().numpy() for _, param in self.net.state_dict().items()]
         self.initial_parameters = self.last_weights = fl.common.weights_to_parameters(initial_params)
         dataset_iterator = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
         dataset_iterator.partition() # distribute data
-        self.test_data = dataset_iterator.load_server_data()
-        self.test_loader = DataLoader(self.test_data, batch_size=config.BATCH_SIZE, pin_memory=True, num_workers=0)
+        if config.SHARD_DIR is not None:
+            export_shards(dataset_iterator, config.SHARD_DIR)
+            self.test_data = load_server_shards(config.SHARD_DIR)
+        else:
+            self.test_data = dataset_iterator.load_server_data()
+        self.test_augment = dataset_iterator.val_augment
+        self.test_loader = self._augmented(make_loader(self.test_data, config.BATCH_SIZE, pin_memory=True, num_workers=0))
+        self.test_targets = get_targets(self.test_data)
+        self.eval_rng = np.random.default_rng(0)
+        self.last_full_accuracy = 0.5 # worst case for sizing the sample until the first full evaluation
         self.current_round = 0
         tb_log_prefix = 'Server_{}' if stage == 'search' else 'Server_valid_{}'
         self.writer = SummaryWriter(log_dir + tb_log_prefix.format(self.date))
         self.rtpt = RTPT('JS', 'FEATHERS_Server', config.ROUNDS)
         self.rtpt.start()
-        self.reward_estimates = np.zeros(len(self.hyperparams))
+        self.reward_estimates = prior_rewards
+        self.explored_rewards = prior_rewards.copy() # estimate of every configuration after the last phase exploring it
         self.alpha = alpha
         self.loss_history = []
         self.discount_factor = baseline_discount
@@ -106,10 +130,17 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.log_round = 0
         self.current_exploration = None
         self.gamma = gamma
+        if not np.all(prior_rewards == 0):
+            logging.info('Warm-started %d configurations from knowledge base', np.count_nonzero(prior_rewards))
+            self.gamma = gamma * config.WARM_START_GAMMA_SCALE
+        self.config_gains = {}
+        self.progress_history = []
+        self.last_exploration_round = None
         self.exploration_mode = exploration_mode
         self.exploration_steps = 0
         self.reward_history = []
         self.stage = stage
+        self.prune_rounds = sorted(config.PRUNE_ROUNDS) # pruning rounds not reached yet
 
         # logging (also logs genotypes)
         self.log_format = '%(asctime)s %(message)s'
@@ -151,9 +182,12 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         samples = np.array([fit_res[1].num_examples for fit_res in results])
         weights = samples / np.sum(samples)
 
+        if 'zero_cost' in results[0][1].metrics:
+            return self._aggregate_zero_cost(weights, results)
+
         self.log_round += 1
 
-        if self.current_round % config.NAS_STEPS == 0: # after NAS_STEPS do exploration
+        if self._exploration_due():
             aggregated_weights = deepcopy(self.old_weights)
             if self.current_exploration is None:
                 self._sample_hyperparams()
@@ -170,10 +204,19 @@ class HANFStrategy(fl.server.strategy.FedAvg):
                 self.current_round += 1
                 self.current_config_idx = int(np.argmax(self.reward_estimates))
                 self.gain_history = []
+                self.last_exploration_round = self.current_round
+                self.progress_history = []
+                # the round counter also advances at the end of an exploration phase
+                if self._prune_due():
+                    aggregated_weights = self._prune_ops(aggregated_weights)
+                    self.old_weights = deepcopy(aggregated_weights)
         else:
             self.current_round += 1
             aggregated_weights, _ = super().aggregate_fit(rnd, results, failures)
+            if self._prune_due():
+                aggregated_weights = self._prune_ops(aggregated_weights)
             self.old_weights = aggregated_weights
+            self.track_progress(weights, results)
         
         # sample hyperparameters and append them to the parameters
         logging.info('hyperparam_configuration = %s', self.hyperparams[self.current_config_idx])
@@ -181,8 +224,129 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         aggregated_weights.tensors.append(serialized_idx.ndarray)
 
         # log_hyper_config(self.hyperparams[self.current_config_idx], rnd, self.writer)
+        if rnd == config.ROUNDS:
+            self.save_run()
+        return aggregated_weights, {}
+
+    def _exploration_due(self):
+        """
+        Decide whether the current round belongs to an exploration phase.
+        With the 'fixed' trigger an exploration phase is started every NAS_STEPS rounds.
+        With the 'plateau' trigger it is started once the last round-over-round gain falls below
+        PLATEAU_TOLERANCE times a discounted baseline of the gains since the last exploration phase,
+        but never before MIN_NAS_STEPS and at the latest after MAX_NAS_STEPS training rounds.
+
+        Returns:
+            bool: True if exploration (still) has to be done in this round.
+        """
+        if self.current_exploration is not None:
+            return True # exploration phase still running
+        if config.EXPLORATION_TRIGGER == 'fixed':
+            return self.current_round % config.NAS_STEPS == 0
+        if self.last_exploration_round is None:
+            return True # no reward estimates yet
+        rounds_since = self.current_round - self.last_exploration_round
+        if rounds_since < config.MIN_NAS_STEPS:
+            return False
+        if rounds_since >= config.MAX_NAS_STEPS:
+            return True # reward estimates are stale
+        if len(self.progress_history) < 2:
+            return False
+        baseline = discounted_mean(np.array(self.progress_history[:-1]), config.PLATEAU_DISCOUNT)
+        stalled = self.progress_history[-1] < config.PLATEAU_TOLERANCE * baseline or baseline <= 0
+        if stalled:
+            logging.info('Progress stalled (gain=%s, baseline=%s), starting exploration', self.progress_history[-1], baseline)
+        return stalled
+
+    def fit_config(self, rnd):
+        """
+        Configuration sent to the clients along with the parameters in each fit-round.
+        """
+        fit_config = {}
+        if config.ROUND_DEADLINE > 0:
+            fit_config['deadline'] = float(config.ROUND_DEADLINE)
+        if rnd == 1 and self.stage == 'search' and config.ZERO_COST_PROXY is not None:
+            fit_config['zero_cost'] = 1 # training-free pre-search round
+        if self.stage == 'search' and config.SEARCH_SAMPLING:
+            # linearly annealed temperature of the clients' Gumbel-softmax op-sampling
+            fit_config['tau'] = config.GUMBEL_TAU_MAX - (config.GUMBEL_TAU_MAX - config.GUMBEL_TAU_MIN) * (rnd - 1) / max(config.ROUNDS - 1, 1)
+        if self.stage == 'search':
+            # cadence of the clients' architecture steps, none in exploration rounds if disabled
+            exploring = self.current_exploration is not None
+            fit_config['arch_every'] = 0 if exploring and not config.ARCH_IN_EXPLORATION else int(config.ARCH_EVERY)
+            fit_config['arch_start'] = float(config.ARCH_START)
+        return fit_config
+
+    def _prune_due(self):
+        # pruning rounds reached since the last check (also several at once) trigger one pruning step
+        if self.stage != 'search':
+            return False
+        due = [r for r in self.prune_rounds if r <= self.current_round]
+        self.prune_rounds = self.prune_rounds[len(due):]
+        return len(due) > 0
+
+    def _prune_ops(self, parameters):
+        """
+        Progressive shrinking of the supernet: mask the PRUNE_OPS ops with the lowest aggregated alphas on every
+        edge (keeping at least PRUNE_MIN_OPS) and physically remove them. Clients take over the masks with the
+        next parameters they receive and send only the weights of the remaining ops from then on.
+        """
+        self.set_parameters(fl.common.parameters_to_weights(parameters))
+        with torch.no_grad():
+            for alphas, mask in zip(self.net.arch_parameters(), self.net.arch_masks()):
+                n_active = mask.sum(dim=1, keepdim=True)
+                n_prune = (n_active - config.PRUNE_MIN_OPS).clamp(min=0, max=config.PRUNE_OPS)
+                # rank of each active op from the bottom, masked ops rank last
+                ranks = alphas.masked_fill(mask == 0, float('inf')).argsort(dim=1).argsort(dim=1)
+                mask.mul_((ranks >= n_prune).float())
+        pruned = self.net.prune_ops()
+        active = sum(int(m.sum().item()) for m in self.net.arch_masks())
+        logging.info('Pruned %d ops, %d candidate ops remain', pruned, active)
+        self.writer.add_scalar('Active_Ops', active, self.current_round)
+        return fl.common.weights_to_parameters([v.cpu().contiguous().numpy() for v in self.net.state_dict().values()])
+
+    def _aggregate_zero_cost(self, weights, results):
+        """
+        Aggregate the clients' zero-cost op-scores of the pre-search round and reduce/bias the search space
+        of the supernet accordingly. The (untrained) weights are sent out unchanged.
+        """
+        scores = np.sum([w * np.frombuffer(res.metrics['zero_cost'], dtype=np.float32) for w, (_, res) in zip(weights, results)], axis=0)
+        shapes = [tuple(m.shape) for m in self.net.arch_masks()]
+        scores = np.split(scores, np.cumsum([int(np.prod(shape)) for shape in shapes])[:-1])
+        apply_scores(self.net, [s.reshape(shape) for s, shape in zip(scores, shapes)], config.ZERO_COST_KEEP, config.ZERO_COST_BIAS)
+        self.net.prune_ops()
+        active = sum(int(m.sum().item()) for m in self.net.arch_masks())
+        total = sum(m.numel() for m in self.net.arch_masks())
+        logging.info('Zero-cost pre-ranking (%s): %d/%d candidate ops active', config.ZERO_COST_PROXY, active, total)
+        self.old_weights = fl.common.weights_to_parameters([v.cpu().contiguous().numpy() for v in self.net.state_dict().values()])
+        aggregated_weights = deepcopy(self.old_weights)
+        if self.current_config_idx is None:
+            self.current_config_idx = 0
+        aggregated_weights.tensors.append(ndarray_to_proto(np.array([self.current_config_idx])).ndarray)
         return aggregated_weights, {}
 
+    def _client_gains(self, results):
+        # before - after per client, normalized to the mean number of local steps if clients did different amounts of work
+        gains = np.array([res.metrics['before'] - res.metrics['after'] for _, res in results])
+        steps = np.array([res.metrics.get('steps', 0) for _, res in results])
+        if np.all(steps > 0):
+            gains = gains * steps.mean() / steps
+        return gains
+
+    def _gain_weights(self, weights, results):
+        # losses measured on small probe sets are noisier, weight them by their inverse variance (~ probe size)
+        probe_sizes = np.array([res.metrics.get('probe', 0) for _, res in results])
+        if np.all(probe_sizes > 0):
+            weights = weights * probe_sizes / np.sum(weights * probe_sizes)
+        return weights
+
+    def track_progress(self, weights, results):
+        # weighted round-over-round gain (avg_before - avg_after) of a training round
+        weights = self._gain_weights(weights, results)
+        gain = np.sum(weights * self._client_gains(results))
+        self.progress_history.append(float(gain))
+        self.writer.add_scalar('Round_Gain', gain, self.current_round)
+
     def _sample_hyperparams(self):
         # obtain new hyperparameter configuration
         if not np.all(self.reward_estimates == 0):
@@ -239,6 +403,8 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         return self.initial_parameters
 
     def set_parameters(self, parameters):
+        if hasattr(self.net, 'arch_masks'):
+            load_arch_masks(self.net, parameters)
         params_dict = zip(self.net.state_dict().keys(), parameters)
         state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
         self.net.load_state_dict(state_dict, strict=True)
@@ -262,6 +428,15 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.reward_estimates += (mask * self.alpha * (rewards - self.reward_estimates)) + ((1 - mask ) * -self.reward_estimates + (1 - mask) * self.alpha * self.reward_estimates)
         logging.info('Reward-estimates = %s', self.reward_estimates)
 
+        # estimates of configurations not explored in this phase are decayed above, keep the last undecayed one
+        self.explored_rewards[sampled_inds] = self.reward_estimates[sampled_inds]
+
+    def save_run(self):
+        # record the run once, at the end of training, s.t. later runs can be warm-started
+        if self.knowledge_base is not None:
+            self.knowledge_base.save_run(self.date, self.knowledge_base_key, self.explored_rewards, self.hyperparams,
+                                         self.config_gains, config.KNOWLEDGE_BASE_TOP_CONFIGS)
+
     def compute_gains(self, weights, results):
         """
         Computes the average gains/progress the model made during the last fit-call.
@@ -279,14 +454,37 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Gains
         """
-        after_losses = [res.metrics['after'] for _, res in results]
-        before_losses = [res.metrics['before'] for _, res in results]
+        weights = self._gain_weights(weights, results)
         hidxs = [res.metrics['hidx'] for _, res in results]
         config_idx = hidxs[0]
         # compute (avg_before - avg_after)
-        avg_gains = np.array([w * (b - a) for w, a, b in zip(weights, after_losses, before_losses)]).sum()
+        avg_gains = np.sum(weights * self._client_gains(results))
         self.gain_history.append([config_idx, avg_gains])
+        self.config_gains.setdefault(int(config_idx), []).append(float(avg_gains))
+
+    def _knowledge_base_key(self, net, stage):
+        # identifies the setting of a run in the knowledge base
+        return {
+            'dataset': config.DATASET,
+            'clients': config.CLIENT_NR,
+            'skew': float(config.DATA_SKEW),
+            'model': f'{type(net).__name__}_{stage}',
+            'params': int(sum(p.numel() for p in net.parameters())),
+        }
+
+
+    def _sampled_test_loader(self):
+        """
+        Draw a fresh stratified sample of the test-set, sized s.t. the confidence interval on accuracy
+        reaches SERVER_EVAL_CI (using the accuracy of the last full evaluation as estimate).
+        """
+        size = sample_size_for_ci(config.SERVER_EVAL_CI, len(self.test_data), config.SERVER_EVAL_CONFIDENCE, 
+                                  p=min(max(self.last_full_accuracy, 0.05), 0.95))
+        inds = stratified_sample(self.test_targets, max(size, len(np.unique(self.test_targets))), self.eval_rng)
+        return self._augmented(make_loader(Subset(self.test_data, inds), config.BATCH_SIZE, pin_memory=True, num_workers=0))
 
+    def _augmented(self, loader):
+        return loader if self.test_augment is None else AugmentedLoader(loader, self.test_augment, DEVICE)
 
     def evaluate(self, parameters: fl.common.typing.Parameters):
         params = []
@@ -297,11 +495,20 @@ class HANFStrategy(fl.server.strategy.FedAvg):
         self.set_parameters(params)
         if self.stage == 'valid':
             self.net.drop_path_prob = config.DROP_PATH_PROB * self.current_round / config.ROUNDS
-        loss, accuracy, f1_micro, f1_macro = _test(self.net, self.test_loader, self.writer, self.current_round, self.stage)
+        full_eval = config.SERVER_EVAL_MODE == 'full' or self.log_round % config.SERVER_EVAL_FULL_EVERY == 0 \
+            or self.log_round >= config.ROUNDS
+        test_loader = self.test_loader if full_eval else self._sampled_test_loader()
+        loss, accuracy, f1_micro, f1_macro = _test(self.net, test_loader, self.writer, self.current_round, self.stage)
+        accuracy_half_width = accuracy_ci(accuracy, len(test_loader.dataset), len(self.test_data), config.SERVER_EVAL_CONFIDENCE)
+        if full_eval:
+            self.last_full_accuracy = accuracy
 
         # log metrics to tensorboard
         self.writer.add_scalar('Test_Loss', loss, self.current_round)
         self.writer.add_scalar('Test_Accuracy', accuracy, self.current_round)
+        self.writer.add_scalar('Test_Accuracy_CI', accuracy_half_width, self.current_round)
+        logging.info('Test_Accuracy = %.4f +- %.4f (%d/%d samples)', accuracy, accuracy_half_width, 
+                     len(test_loader.dataset), len(self.test_data))
         self.writer.add_scalar('Test_F1_Micro', f1_micro)
         self.writer.add_scalar('Test_F1_Macro', f1_macro)
         log_model_weights(self.net, self.current_round, self.writer)
@@ -29,6 +29,11 @@ class Hyperparameters:
             arr.append(row.to_dict())
         self.hyperparams = arr
 
+    def seed(self, configs):
+        # replace the first len(configs) sampled configurations by the given ones
+        for i, config in enumerate(configs[:len(self.hyperparams)]):
+            self.hyperparams[i] = config
+
     def save(self, file):
         df = pd.DataFrame.from_dict(self.to_dict())
         df.to_csv(file)
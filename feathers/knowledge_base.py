@@ -0,0 +1,120 @@
+import fcntl
+import json
+import os
+import tempfile
+import numpy as np
+
+
+class KnowledgeBase:
+
+    def __init__(self, file) -> None:
+        """
+        Local store of finished HANF searches. Each run is one record holding the
+        setting it was run in (dataset, number of clients, data-skew and model shape), its final
+        reward estimates, its best hyperparameter-configurations and the gains observed for them.
+
+        Args:
+            file (str): JSON-file the records are persisted in.
+        """
+        self.file = file
+        self.records = []
+        if os.path.exists(file):
+            with open(file, 'r') as f:
+                self.records = json.load(f)
+
+    def save_run(self, run_id, key, reward_estimates, hyperparams, config_gains, top_k=10):
+        """
+        Insert the record of a finished run (replacing an earlier record with the same id).
+
+        Args:
+            run_id (str): Unique id of the run (the strategy's start date).
+            key (dict): Setting of the run, see HANFStrategy._knowledge_base_key.
+            reward_estimates (np.ndarray): Final reward estimates, one per configuration.
+            hyperparams (Hyperparameters): Configuration pool of the run.
+            config_gains (dict): Maps configuration-index to the list of gains observed for it.
+            top_k (int, optional): Number of best (explored) configurations to keep. Defaults to 10.
+        """
+        explored = [idx for idx in config_gains.keys() if len(config_gains[idx]) > 0]
+        explored = sorted(explored, key=lambda idx: -reward_estimates[idx])[:top_k]
+        best_configs = [{
+            'config': {k: float(v) for k, v in hyperparams[idx].items()},
+            'reward': float(reward_estimates[idx]),
+            'gains': [float(g) for g in config_gains[idx]],
+        } for idx in explored]
+        record = {
+            'run_id': run_id,
+            'key': key,
+            'reward_estimates': [float(r) for r in reward_estimates],
+            'best_configs': best_configs,
+        }
+        # runs sharing the file update it one after another, records of the others are re-read under the lock
+        with open(self.file + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.file):
+                with open(self.file, 'r') as f:
+                    self.records = json.load(f)
+            self.records = [r for r in self.records if r['run_id'] != run_id] + [record]
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.file)), delete=False) as f:
+                json.dump(self.records, f)
+            os.replace(f.name, self.file)
+
+    def nearest_runs(self, key, n=3, exclude=None):
+        """
+        Find the n runs closest to the given setting. Only runs on the same dataset and with the
+        same kind of model are considered. Distance is measured on the (log) number of clients,
+        the data-skew and the (log) number of model parameters.
+
+        Args:
+            key (dict): Setting to look up.
+            n (int, optional): Maximum number of runs to return. Defaults to 3.
+            exclude (str, optional): Run-id to ignore (usually the current run). Defaults to None.
+
+        Returns:
+            list: Records of the nearest runs, closest first.
+        """
+        candidates = []
+        for record in self.records:
+            other = record['key']
+            if record['run_id'] == exclude or len(record['best_configs']) == 0:
+                continue
+            if other['dataset'] != key['dataset'] or other['model'] != key['model']:
+                continue
+            dist = abs(np.log(other['clients']) - np.log(key['clients'])) \
+                + abs(other['skew'] - key['skew']) \
+                + abs(np.log(other['params']) - np.log(key['params']))
+            candidates.append((dist, record))
+        candidates = sorted(candidates, key=lambda c: c[0])
+        return [record for _, record in candidates[:n]]
+
+    def warm_start(self, key, hyperparams, n_runs=3, n_configs=20, prior_weight=0.5, exclude=None):
+        """
+        Seed a configuration pool with the best configurations of the nearest previous runs and
+        derive prior reward estimates for them. Seeded configurations replace the first entries of the pool.
+        Configurations of a neighbour are weighted by 1/(rank+1) of the neighbour, s.t. closer runs dominate.
+
+        Args:
+            key (dict): Setting of the current run.
+            hyperparams (Hyperparameters): Freshly sampled pool, modified in place.
+            n_runs (int, optional): Number of neighbouring runs to use. Defaults to 3.
+            n_configs (int, optional): Maximum number of configurations to seed. Defaults to 20.
+            prior_weight (float, optional): Scale of the prior rewards relative to the stored estimates. Defaults to 0.5.
+            exclude (str, optional): Run-id to ignore. Defaults to None.
+
+        Returns:
+            np.ndarray: Prior reward estimates for the whole pool (zeros if nothing was found).
+        """
+        priors = np.zeros(len(hyperparams))
+        config_keys = set(hyperparams[0].keys())
+        seeds = {}
+        for rank, record in enumerate(self.nearest_runs(key, n_runs, exclude)):
+            for entry in record['best_configs']:
+                if set(entry['config'].keys()) != config_keys:
+                    continue
+                cfg_id = tuple(sorted(entry['config'].items()))
+                reward, weight = seeds.get(cfg_id, (0.0, 0.0))
+                seeds[cfg_id] = (reward + entry['reward'] / (rank + 1), weight + 1 / (rank + 1))
+        seeds = sorted(seeds.items(), key=lambda s: -s[1][0] / s[1][1])[:min(n_configs, len(hyperparams))]
+        hyperparams.seed([dict(cfg_id) for cfg_id, _ in seeds])
+        for idx, (_, (reward, weight)) in enumerate(seeds):
+            priors[idx] = prior_weight * reward / weight
+        return priors
@@ -1,15 +1,16 @@
 import torch
 import torch.nn as nn
 from operations import *
-from utils import drop_path
+from utils import drop_path, checkpointed
 
 class Cell(nn.Module):
 
-  def __init__(self, genotype, C_prev_prev, C_prev, C, reduction, reduction_prev, device):
+  def __init__(self, genotype, C_prev_prev, C_prev, C, reduction, reduction_prev, device, checkpoint_ops=False):
     super(Cell, self).__init__()
     print(C_prev_prev, C_prev, C)
 
     self.device = device
+    self.checkpoint_ops = checkpoint_ops
     if reduction_prev:
       self.preprocess0 = FactorizedReduce(C_prev_prev, C)
     else:
@@ -47,8 +48,8 @@ class Cell(nn.Module):
       h2 = states[self._indices[2*i+1]]
       op1 = self._ops[2*i]
       op2 = self._ops[2*i+1]
-      h1 = op1(h1)
-      h2 = op2(h2)
+      h1 = self._op(op1, h1)
+      h2 = self._op(op2, h2)
       if self.training and drop_prob > 0.:
         if not isinstance(op1, Identity):
           h1 = drop_path(h1, drop_prob, self.device)
@@ -58,6 +59,24 @@ class Cell(nn.Module):
       states += [s]
     return torch.cat([states[i] for i in self._concat], dim=1)
 
+  def _op(self, op, h):
+    if self.checkpoint_ops and self.training and torch.is_grad_enabled() and not isinstance(op, Identity):
+      return checkpointed(op, h)
+    return op(h)
+
+def _cells(network, s0, s1):
+  # run the cells of NetworkCIFAR/NetworkImageNet, with per-cell checkpointing if enabled
+  logits_aux = None
+  for i, cell in enumerate(network.cells):
+    if network._checkpoint == 'cell' and network.training and torch.is_grad_enabled():
+      s0, s1 = s1, checkpointed(cell, s0, s1, network.drop_path_prob)
+    else:
+      s0, s1 = s1, cell(s0, s1, network.drop_path_prob)
+    if i == 2*network._layers//3:
+      if network._auxiliary and network.training:
+        logits_aux = network.auxiliary_head(s1)
+  return s1, logits_aux
+
 
 class AuxiliaryHeadCIFAR(nn.Module):
 
@@ -109,10 +128,11 @@ class AuxiliaryHeadImageNet(nn.Module):
 
 class NetworkCIFAR(nn.Module):
 
-  def __init__(self, C, num_classes, layers, auxiliary, genotype, device, in_channels=3):
+  def __init__(self, C, num_classes, layers, auxiliary, genotype, device, in_channels=3, checkpoint=None):
     super(NetworkCIFAR, self).__init__()
     self._layers = layers
     self._auxiliary = auxiliary
+    self._checkpoint = checkpoint # activation checkpointing: None, 'cell' or 'op'
     self.drop_path_prob = 0.2
 
     stem_multiplier = 3
@@ -131,7 +151,7 @@ class NetworkCIFAR(nn.Module):
         reduction = True
       else:
         reduction = False
-      cell = Cell(genotype, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, device)
+      cell = Cell(genotype, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, device, checkpoint == 'op')
       reduction_prev = reduction
       self.cells += [cell]
       C_prev_prev, C_prev = C_prev, cell.multiplier*C_curr
@@ -144,13 +164,8 @@ class NetworkCIFAR(nn.Module):
     self.classifier = nn.Linear(C_prev, num_classes)
 
   def forward(self, input):
-    logits_aux = None
     s0 = s1 = self.stem(input)
-    for i, cell in enumerate(self.cells):
-      s0, s1 = s1, cell(s0, s1, self.drop_path_prob)
-      if i == 2*self._layers//3:
-        if self._auxiliary and self.training:
-          logits_aux = self.auxiliary_head(s1)
+    s1, logits_aux = _cells(self, s0, s1)
     out = self.global_pooling(s1)
     logits = self.classifier(out.view(out.size(0),-1))
     return logits, logits_aux
@@ -158,10 +173,11 @@ class NetworkCIFAR(nn.Module):
 
 class NetworkImageNet(nn.Module):
 
-  def __init__(self, C, num_classes, layers, auxiliary, genotype, device):
+  def __init__(self, C, num_classes, layers, auxiliary, genotype, device, checkpoint=None):
     super(NetworkImageNet, self).__init__()
     self._layers = layers
     self._auxiliary = auxiliary
+    self._checkpoint = checkpoint # activation checkpointing: None, 'cell' or 'op'
     self.drop_path_prob = 0.2
 
     self.stem0 = nn.Sequential(
@@ -188,7 +204,7 @@ class NetworkImageNet(nn.Module):
         reduction = True
       else:
         reduction = False
-      cell = Cell(genotype, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, device)
+      cell = Cell(genotype, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, device, checkpoint == 'op')
       reduction_prev = reduction
       self.cells += [cell]
       C_prev_prev, C_prev = C_prev, cell.multiplier * C_curr
@@ -201,14 +217,9 @@ class NetworkImageNet(nn.Module):
     self.classifier = nn.Linear(C_prev, num_classes)
 
   def forward(self, input):
-    logits_aux = None
     s0 = self.stem0(input)
     s1 = self.stem1(s0)
-    for i, cell in enumerate(self.cells):
-      s0, s1 = s1, cell(s0, s1, self.drop_path_prob)
-      if i == 2 * self._layers // 3:
-        if self._auxiliary and self.training:
-          logits_aux = self.auxiliary_head(s1)
+    s1, logits_aux = _cells(self, s0, s1)
     out = self.global_pooling(s1)
     logits = self.classifier(out.view(out.size(0), -1))
     return logits, logits_aux
@@ -3,28 +3,180 @@ import torch.nn as nn
 import torch.nn.functional as F
 from operations import *
 from genotypes import PRIMITIVES, TABULAR_PRIMITIVES
-from genotypes import Genotype, TabularGenotype, drop_path
+from genotypes import Genotype, TabularGenotype
+from utils import drop_path, checkpointed
+
+def _active_ops(mask):
+  # indices of the unmasked ops per edge (one host-sync per forward instead of one per op)
+  return [[i for i, m in enumerate(row) if m > 0] for row in mask.tolist()]
+
+def _masked_weights(alphas, mask):
+  # softmax over the unmasked ops only, masked ops get weight 0
+  return F.softmax(alphas.masked_fill(mask == 0, float('-inf')), dim=-1), _active_ops(mask)
+
+def _sampled_weights(alphas, mask, tau, k=1):
+  """
+  Gumbel-softmax sample of k unmasked ops per edge (GDAS). In the forward pass the sampled ops are averaged
+  with weight 1/k, the gradient w.r.t. the alphas is the one of the relaxed sample (straight-through).
+  """
+  logits = alphas.masked_fill(mask == 0, float('-inf'))
+  gumbels = -torch.empty_like(logits).exponential_().log()
+  soft = F.softmax((logits + gumbels) / tau, dim=-1)
+  hard = torch.zeros_like(soft).scatter_(1, soft.topk(k, dim=-1).indices, 1.) * (mask > 0)
+  hard = hard / hard.sum(dim=-1, keepdim=True)
+  return hard - soft.detach() + soft, _active_ops(hard)
+
+def load_arch_masks(model, parameters):
+  """
+  Take over the op-masks from a list of parameters in state-dict order and physically remove the masked ops,
+  s.t. the remaining parameters can be zipped with the (now smaller) state-dict. The masks are buffers of the
+  network itself and thus always precede the parameters of its cells.
+  """
+  keys = list(model.state_dict().keys())
+  with torch.no_grad():
+    for name, mask in zip(model.arch_mask_names(), model.arch_masks()):
+      mask.copy_(torch.as_tensor(parameters[keys.index(name)]))
+  model.prune_ops()
+
+class PrunedOp(nn.Module):
+  # parameter-free placeholder of an op removed from the search space, never evaluated
+
+  def forward(self, x):
+    raise RuntimeError('Pruned operation must not be evaluated')
+
+def _prune(mixed_ops, masks):
+  pruned = 0
+  for mixed_op, row in zip(mixed_ops, masks):
+    for i, m in enumerate(row):
+      if m == 0 and not isinstance(mixed_op._ops[i], PrunedOp):
+        mixed_op._ops[i] = PrunedOp()
+        pruned += 1
+  return pruned
+
+def channel_shuffle(x, groups):
+  # keeps the memory format (channels-last) of x
+  memory_format = torch.channels_last if x.is_contiguous(memory_format=torch.channels_last) else torch.contiguous_format
+  batchsize, num_channels, height, width = x.size()
+  x = x.view(batchsize, groups, num_channels // groups, height, width)
+  x = torch.transpose(x, 1, 2).reshape(batchsize, -1, height, width)
+  return x.contiguous(memory_format=memory_format)
 
 class MixedOp(nn.Module):
 
-  def __init__(self, C, stride):
+  def __init__(self, C, stride, partial_channels=1):
     super(MixedOp, self).__init__()
+    # partial channel connections (PC-DARTS): only C // partial_channels channels pass the candidate ops
+    self._k = partial_channels
     self._ops = nn.ModuleList()
+    if self._k > 1:
+      self.mp = nn.MaxPool2d(2, 2)
     for primitive in PRIMITIVES:
-      op = OPS[primitive](C, stride, False)
+      op = OPS[primitive](C // self._k, stride, False)
       if 'pool' in primitive:
-        op = nn.Sequential(op, nn.BatchNorm2d(C, affine=False))
+        op = nn.Sequential(op, nn.BatchNorm2d(C // self._k, affine=False))
       self._ops.append(op)
 
-  def forward(self, x, weights):
-    return sum(w * op(x) for w, op in zip(weights, self._ops))
+  def forward(self, x, weights, active=None):
+    # active: indices of the ops not masked out, only those are computed
+    active = range(len(self._ops)) if active is None else active
+    if self._k == 1:
+      return self._mix(x, weights, active)
+    dim = x.shape[1] // self._k
+    xtemp, xtemp2 = x[:, :dim], x[:, dim:]
+    temp1 = self._mix(xtemp, weights, active)
+    # the bypassed channels only need to match the spatial size of reducing edges
+    ans = torch.cat([temp1, xtemp2 if temp1.shape[2] == x.shape[2] else self.mp(xtemp2)], dim=1)
+    return channel_shuffle(ans, self._k)
+
+  def _mix(self, x, weights, active):
+    return sum(weights[i] * self._ops[i](x) for i in active)
+
+
+def _stacked_batch_norm(bns, x):
+  # one batch-norm over the channel-wise concatenation of the inputs of bns, running statistics are written back
+  n = len(bns)
+  mean = torch.cat([bn.running_mean for bn in bns])
+  var = torch.cat([bn.running_var for bn in bns])
+  weight = torch.cat([bn.weight for bn in bns]) if bns[0].affine else None
+  bias = torch.cat([bn.bias for bn in bns]) if bns[0].affine else None
+  out = F.batch_norm(x, mean, var, weight, bias, bns[0].training, bns[0].momentum, bns[0].eps)
+  if bns[0].training:
+    for bn, m, v in zip(bns, mean.chunk(n), var.chunk(n)):
+      bn.running_mean.copy_(m)
+      bn.running_var.copy_(v)
+      bn.num_batches_tracked.add_(1)
+  return out
+
+def _stacked_depthwise(convs, x, kernel_size):
+  # depthwise convs with "same" padding, kernels zero-padded to kernel_size, as one conv over the stacked inputs
+  weight = torch.cat([F.pad(c.weight, [(kernel_size - c.kernel_size[0]) // 2] * 4) for c in convs])
+  return F.conv2d(x, weight, stride=convs[0].stride, padding=kernel_size // 2, groups=x.shape[1])
+
+def _stacked_pointwise(convs, x):
+  return F.conv2d(x, torch.cat([c.weight for c in convs]), groups=len(convs))
+
+def _fusable(op):
+  # SepConv with "same" padding and without dilation
+  convs = [op.op[1], op.op[5]]
+  return all(c.dilation == (1, 1) and c.kernel_size[0] == c.kernel_size[1] and c.padding[0] == c.padding[1] == c.kernel_size[0] // 2
+             for c in convs)
+
+class FusedMixedOp(MixedOp):
+  """
+  MixedOp computing the weighted sum of its ops with fewer kernels. The modules (and thus the state-dict) are
+  the ones of MixedOp, only the evaluation differs: the zero-op is skipped (its weighted output is 0), the
+  leading ReLU of the conv-ops is computed once and all separable convolutions run as one grouped convolution
+  per stage, the outputs are accumulated in place.
+  """
+
+  def _mix(self, x, weights, active):
+    out, relu, sep_convs = None, None, []
+    for i in active:
+      op = self._ops[i]
+      if isinstance(op, Zero):
+        continue
+      if isinstance(op, (SepConv, DilConv, FactorizedReduce)) and relu is None:
+        relu = F.relu(x)
+      if isinstance(op, SepConv) and _fusable(op):
+        sep_convs.append(i)
+        continue
+      if isinstance(op, (SepConv, DilConv)):
+        y = op.op[1:](relu)
+      elif isinstance(op, FactorizedReduce):
+        y = op.bn(torch.cat([op.conv_1(relu), op.conv_2(relu[:, :, 1:, 1:])], dim=1))
+      else:
+        y = op(x)
+      out = weights[i] * y if out is None else out.addcmul_(weights[i], y)
+    if len(sep_convs) > 0:
+      for i, y in zip(sep_convs, self._sep_convs([self._ops[i] for i in sep_convs], relu)):
+        out = weights[i] * y if out is None else out.addcmul_(weights[i], y)
+    if out is None:
+      # only the zero-op is active
+      return super()._mix(x, weights, active)
+    return out
+
+  @staticmethod
+  def _sep_convs(ops, x):
+    n = len(ops)
+    if n == 1:
+      return [ops[0].op[1:](x)]
+    kernel_size = max(op.op[1].kernel_size[0] for op in ops)
+    h = _stacked_depthwise([op.op[1] for op in ops], x.repeat(1, n, 1, 1), kernel_size)
+    h = _stacked_pointwise([op.op[2] for op in ops], h)
+    h = F.relu(_stacked_batch_norm([op.op[3] for op in ops], h))
+    h = _stacked_depthwise([op.op[5] for op in ops], h, kernel_size)
+    h = _stacked_pointwise([op.op[6] for op in ops], h)
+    h = _stacked_batch_norm([op.op[7] for op in ops], h)
+    return h.chunk(n, dim=1)
 
 
 class Cell(nn.Module):
 
-  def __init__(self, steps, multiplier, C_prev_prev, C_prev, C, reduction, reduction_prev):
+  def __init__(self, steps, multiplier, C_prev_prev, C_prev, C, reduction, reduction_prev, partial_channels=1, fused=False,
+               checkpoint_ops=False):
     super(Cell, self).__init__()
     self.reduction = reduction
+    self.checkpoint_ops = checkpoint_ops
 
     if reduction_prev:
       self.preprocess0 = FactorizedReduce(C_prev_prev, C, affine=False)
@@ -39,30 +191,39 @@ class Cell(nn.Module):
     for i in range(self._steps):
       for j in range(2+i):
         stride = 2 if reduction and j < 2 else 1
-        op = MixedOp(C, stride)
+        op = (FusedMixedOp if fused else MixedOp)(C, stride, partial_channels)
         self._ops.append(op)
 
-  def forward(self, s0, s1, weights, drop_prob=0.0):
+  def forward(self, s0, s1, weights, drop_prob=0.0, active=None, edge_weights=None):
+    # edge_weights: normalized weights of the edges into each node (PC-DARTS edge normalization), None = all 1
     s0 = self.preprocess0(s0)
     s1 = self.preprocess1(s1)
 
+    active = [None] * len(self._ops) if active is None else active
+    edge_weights = [1.] * len(self._ops) if edge_weights is None else edge_weights
     states = [s0, s1]
     offset = 0
     for i in range(self._steps):
       if drop_prob > 0. and self.training:
-        s = sum(drop_path(self._ops[offset+j](h, weights[offset+j]), drop_prob) for j, h in enumerate(states))
+        s = sum(edge_weights[offset+j] * drop_path(self._op(offset+j, h, weights[offset+j], active[offset+j]), drop_prob, h.device) for j, h in enumerate(states))
       else:
-        s = sum(self._ops[offset+j](h, weights[offset+j]) for j, h in enumerate(states))
+        s = sum(edge_weights[offset+j] * self._op(offset+j, h, weights[offset+j], active[offset+j]) for j, h in enumerate(states))
       offset += len(states)
       states.append(s)
 
     return torch.cat(states[-self._multiplier:], dim=1)
 
+  def _op(self, i, h, weights, active):
+    if self.checkpoint_ops and self.training and torch.is_grad_enabled():
+      return checkpointed(self._ops[i], h, weights, active)
+    return self._ops[i](h, weights, active)
+
 
 class Network(nn.Module):
 
   def __init__(self, C, num_classes, layers, criterion, device, in_channels=3, 
-              steps=4, multiplier=4, stem_multiplier=3, drop_path_prob=0.0):
+              steps=4, multiplier=4, stem_multiplier=3, drop_path_prob=0.0, partial_channels=1, fused=False,
+              sampled_ops=1, checkpoint=None):
     super(Network, self).__init__()
     self._C = C
     self._num_classes = num_classes
@@ -72,6 +233,13 @@ class Network(nn.Module):
     self._multiplier = multiplier
     self.device = device
     self.drop_path_prob = drop_path_prob
+    self._partial_channels = partial_channels
+    self._fused = fused
+    # temperature of the Gumbel-softmax sampling of sampled_ops ops per edge in training, None = all ops weighted by softmax
+    self.tau = None
+    self._sampled_ops = sampled_ops
+    # activation checkpointing: None, 'cell' or 'op' (each mixed op)
+    self._checkpoint = checkpoint
 
     C_curr = stem_multiplier*C
     self.stem = nn.Sequential(
@@ -88,7 +256,8 @@ class Network(nn.Module):
         reduction = True
       else:
         reduction = False
-      cell = Cell(steps, multiplier, C_prev_prev, C_prev, C_curr, reduction, reduction_prev)
+      cell = Cell(steps, multiplier, C_prev_prev, C_prev, C_curr, reduction, reduction_prev, partial_channels, fused,
+                  checkpoint == 'op')
       reduction_prev = reduction
       self.cells += [cell]
       C_prev_prev, C_prev = C_prev, multiplier*C_curr
@@ -99,19 +268,36 @@ class Network(nn.Module):
     self._initialize_alphas()
 
   def new(self):
-    model_new = Network(self._C, self._num_classes, self._layers, self._criterion, self.device).to(self.device)
+    model_new = Network(self._C, self._num_classes, self._layers, self._criterion, self.device,
+                        partial_channels=self._partial_channels, fused=self._fused,
+                        sampled_ops=self._sampled_ops, checkpoint=self._checkpoint).to(self.device)
+    model_new.tau = self.tau
     for x, y in zip(model_new.arch_parameters(), self.arch_parameters()):
         x.data.copy_(y.data)
+    for x, y in zip(model_new.arch_masks(), self.arch_masks()):
+        x.copy_(y)
+    model_new.prune_ops()
     return model_new
 
   def forward(self, input):
     s0 = s1 = self.stem(input)
+    if self.training and self.tau is not None:
+      weights_normal, active_normal = _sampled_weights(self.alphas_normal, self.mask_normal, self.tau, self._sampled_ops)
+      weights_reduce, active_reduce = _sampled_weights(self.alphas_reduce, self.mask_reduce, self.tau, self._sampled_ops)
+    else:
+      weights_normal, active_normal = _masked_weights(self.alphas_normal, self.mask_normal)
+      weights_reduce, active_reduce = _masked_weights(self.alphas_reduce, self.mask_reduce)
+    edges_normal = self._edge_weights(self.betas_normal) if self._partial_channels > 1 else None
+    edges_reduce = self._edge_weights(self.betas_reduce) if self._partial_channels > 1 else None
     for i, cell in enumerate(self.cells):
       if cell.reduction:
-        weights = F.softmax(self.alphas_reduce, dim=-1)
+        weights, active, edges = weights_reduce, active_reduce, edges_reduce
+      else:
+        weights, active, edges = weights_normal, active_normal, edges_normal
+      if self._checkpoint == 'cell' and self.training and torch.is_grad_enabled():
+        s0, s1 = s1, checkpointed(cell, s0, s1, weights, self.drop_path_prob, active, edges)
       else:
-        weights = F.softmax(self.alphas_normal, dim=-1)
-      s0, s1 = s1, cell(s0, s1, weights, self.drop_path_prob)
+        s0, s1 = s1, cell(s0, s1, weights, self.drop_path_prob, active, edges)
     out = self.global_pooling(s1)
     logits = self.classifier(out.view(out.size(0),-1))
     return logits
@@ -120,6 +306,14 @@ class Network(nn.Module):
     logits = self(input)
     return self._criterion(logits, target) 
 
+  def _edge_weights(self, betas):
+    # softmax over the incoming edges of every intermediate node
+    weights, start = [], 0
+    for i in range(self._steps):
+      weights.append(F.softmax(betas[start:start+2+i], dim=-1))
+      start += 2 + i
+    return torch.cat(weights)
+
   def _initialize_alphas(self):
     k = sum(1 for i in range(self._steps) for n in range(2+i))
     num_ops = len(PRIMITIVES)
@@ -130,10 +324,34 @@ class Network(nn.Module):
       self.alphas_normal,
       self.alphas_reduce,
     ]
+    if self._partial_channels > 1:
+      # edge normalization weights, only part of the state-dict (and thus federated) in partial channel mode
+      self.betas_normal = nn.Parameter(1e-3*torch.randn(k).to(self.device), requires_grad=True)
+      self.betas_reduce = nn.Parameter(1e-3*torch.randn(k).to(self.device), requires_grad=True)
+      self._arch_parameters += [self.betas_normal, self.betas_reduce]
+    # 1 = op is part of the search space, 0 = pruned (not computed). Buffers, s.t. they are federated with the state-dict
+    self.register_buffer('mask_normal', torch.ones(k, num_ops, device=self.device))
+    self.register_buffer('mask_reduce', torch.ones(k, num_ops, device=self.device))
 
   def arch_parameters(self):
     return self._arch_parameters
 
+  def arch_masks(self):
+    return [self.mask_normal, self.mask_reduce]
+
+  def arch_mask_names(self):
+    return ['mask_normal', 'mask_reduce']
+
+  def prune_ops(self):
+    """
+    Replace all masked ops by parameter-free placeholders, removing their weights from the state-dict.
+
+    Returns:
+      int: Number of ops removed
+    """
+    normal, reduce = self.mask_normal.tolist(), self.mask_reduce.tolist()
+    return sum(_prune(cell._ops, reduce if cell.reduction else normal) for cell in self.cells)
+
   def genotype(self):
 
     def _parse(weights):
@@ -155,8 +373,13 @@ class Network(nn.Module):
         n += 1
       return gene
 
-    gene_normal = _parse(F.softmax(self.alphas_normal, dim=-1).data.cpu().numpy())
-    gene_reduce = _parse(F.softmax(self.alphas_reduce, dim=-1).data.cpu().numpy())
+    weights_normal = _masked_weights(self.alphas_normal, self.mask_normal)[0]
+    weights_reduce = _masked_weights(self.alphas_reduce, self.mask_reduce)[0]
+    if self._partial_channels > 1:
+      weights_normal = weights_normal * self._edge_weights(self.betas_normal).unsqueeze(1)
+      weights_reduce = weights_reduce * self._edge_weights(self.betas_reduce).unsqueeze(1)
+    gene_normal = _parse(weights_normal.data.cpu().numpy())
+    gene_reduce = _parse(weights_reduce.data.cpu().numpy())
 
     concat = range(2+self._steps-self._multiplier, self._steps+2)
     genotype = Genotype(
@@ -174,8 +397,9 @@ class TabularMixedOp(nn.Module):
       op = TABOPS[primitive](in_dim, out_dim)
       self._ops.append(op)
 
-  def forward(self, x, weights):
-    return sum(w * op(x) for w, op in zip(weights, self._ops))
+  def forward(self, x, weights, active=None):
+    active = range(len(self._ops)) if active is None else active
+    return sum(weights[i] * self._ops[i](x) for i in active)
 
 
 class TabularNetwork(nn.Module):
@@ -197,11 +421,13 @@ class TabularNetwork(nn.Module):
 
     num_cells = len(in_dims)
     self.alphas = nn.Parameter(1e-3*torch.randn(num_cells, len(TABULAR_PRIMITIVES)).to(self.device))
+    self.register_buffer('mask', torch.ones(num_cells, len(TABULAR_PRIMITIVES), device=self.device))
 
   def forward(self, x):
+    active = _active_ops(self.mask)
     for i, cell in enumerate(self.cells):
-      weights = self.alphas[i, :]
-      x = cell(x, weights)
+      weights = self.alphas[i, :] * self.mask[i, :]
+      x = cell(x, weights, active[i])
     
     if self.classes == 2:
       return torch.sigmoid(torch.squeeze(self.linear(x)))
@@ -216,8 +442,17 @@ class TabularNetwork(nn.Module):
   def arch_parameters(self):
     return [self.alphas]
 
+  def arch_masks(self):
+    return [self.mask]
+
+  def arch_mask_names(self):
+    return ['mask']
+
+  def prune_ops(self):
+    return _prune(self.cells, self.mask.tolist())
+
   def genotype(self):
-    weights = self.alphas # ignore zero-operation
+    weights = self.alphas.masked_fill(self.mask == 0, float('-inf')) # ignore zero-operation
     _, ops = torch.max(weights, dim=1)
     arch = []
     for idx in ops:
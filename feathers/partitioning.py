@@ -0,0 +1,228 @@
+import os
+import shutil
+import time
+import numpy as np
+
+SCHEMES = ['iid', 'label', 'dirichlet', 'shards', 'quantity']
+VERSION = 2 # part of the cache-key, partitions cached by older versions of the schemes are not reused
+
+
+def label_skew_proportions(n_classes, n_clients, skew):
+    """
+    Class-to-client proportions following the scheme of label_distribution_skew: groups of labels are assigned
+    to groups of clients, a fraction of skew of each label goes to its group, the rest is spread uniformly.
+    skew=0 yields an iid partition. Both only agree if the label groups exactly cover the clients
+    (e.g. 10 classes on 2, 5 or 10 clients). Otherwise label_distribution_skew drops the skewed share of label
+    groups beyond the last client (e.g. label 9 with 3 clients) and builds fewer partitions than clients
+    if there are fewer groups, whereas here surplus groups wrap around to the first clients and clients
+    without a group only get their uniform share.
+    """
+    n_labels = round(max(1, n_classes / n_clients))
+    n_runners = round(max(1, n_clients / n_classes))
+    proportions = np.full((n_classes, n_clients), (1 - skew) / n_clients)
+    group_clients = (np.arange(n_classes)[:, None] // n_labels * n_runners + np.arange(n_runners)) % n_clients
+    proportions[np.arange(n_classes)[:, None], group_clients] += skew / n_runners
+    return proportions
+
+def dirichlet_proportions(n_classes, n_clients, alpha, rng):
+    """
+    Class-to-client proportions drawn from Dir(alpha) per class. Small alpha = strong label skew.
+    """
+    return rng.dirichlet(np.full(n_clients, alpha), size=n_classes)
+
+def assign_by_class(targets, proportions, rng):
+    """
+    Assign every sample to a client s.t. client k holds (roughly) proportions[c, k] of the samples of class c.
+
+    Args:
+        targets (np.ndarray): Integer labels of all samples
+        proportions (np.ndarray): Array of shape (classes, clients), rows summing up to 1
+        rng (np.random.Generator): Random generator
+
+    Returns:
+        np.ndarray: Client of each sample
+    """
+    n_classes, n_clients = proportions.shape
+    order = rng.permutation(len(targets))
+    order = order[np.argsort(targets[order], kind='stable')] # grouped by class, random within a class
+    counts = np.bincount(targets, minlength=n_classes)
+    # integer quotas per class and client by largest remainder, carried over the classes s.t. the rounding does not
+    # fall the same way in every class: every client ends up within one sample of its expected total
+    quotas = np.zeros((n_classes, n_clients), dtype=np.int64)
+    expected, assigned = np.zeros(n_clients), np.zeros(n_clients, dtype=np.int64)
+    for c in range(n_classes):
+        expected += proportions[c] * counts[c]
+        quota = np.maximum(np.floor(expected).astype(np.int64) - assigned, 0)
+        remainder = expected - assigned - quota
+        rest = counts[c] - quota.sum()
+        ties = rng.permutation(n_clients) # random order among equal remainders
+        if rest > 0:
+            quota[ties[np.argsort(-remainder[ties], kind='stable')[:rest]]] += 1
+        elif rest < 0:
+            candidates = ties[np.argsort(remainder[ties], kind='stable')]
+            candidates = candidates[quota[candidates] > 0][:-rest]
+            quota[candidates] -= 1
+        quotas[c] = quota
+        assigned += quota
+    assignment = np.empty(len(targets), dtype=np.int64)
+    assignment[order] = np.concatenate([np.repeat(np.arange(n_clients), quotas[c]) for c in range(n_classes)])
+    return assignment
+
+def assign_iid(n_samples, n_clients, rng):
+    """
+    Assign samples uniformly at random, client sizes differ by at most one sample (as with np.array_split).
+    """
+    assignment = np.empty(n_samples, dtype=np.int64)
+    assignment[rng.permutation(n_samples)] = np.arange(n_samples) * n_clients // max(n_samples, 1)
+    return assignment
+
+def fill_empty(assignment, n_clients, rng):
+    """
+    Move single random samples from the largest clients to clients without any sample (in place), s.t. no
+    client ends up with an empty partition. Fails if there are fewer samples than clients.
+    """
+    counts = np.bincount(assignment, minlength=n_clients)
+    empty = np.flatnonzero(counts == 0)
+    if len(empty) == 0:
+        return assignment
+    if len(assignment) < n_clients:
+        raise ValueError('Cannot split {} samples among {} clients without empty partitions'.format(len(assignment), n_clients))
+    for client in empty:
+        donor = np.argmax(counts)
+        sample = rng.choice(np.flatnonzero(assignment == donor))
+        assignment[sample] = client
+        counts[donor] -= 1
+        counts[client] += 1
+    return assignment
+
+def assign_shards(targets, owners, rng):
+    """
+    Sort samples by label, cut them into len(owners) equally sized shards and give shard j to client owners[j].
+    """
+    order = rng.permutation(len(targets))
+    order = order[np.argsort(targets[order], kind='stable')]
+    shards = np.arange(len(targets)) * len(owners) // max(len(targets), 1)
+    assignment = np.empty(len(targets), dtype=np.int64)
+    assignment[order] = owners[shards]
+    return assignment
+
+def assign_quantity(n_samples, proportions, rng):
+    """
+    Assign samples uniformly at random, client k receiving a fraction of proportions[k] of all samples.
+    """
+    position = np.arange(n_samples) / max(n_samples, 1)
+    clients = np.clip(np.searchsorted(np.cumsum(proportions), position, side='right'), 0, len(proportions) - 1)
+    assignment = np.empty(n_samples, dtype=np.int64)
+    assignment[rng.permutation(n_samples)] = clients
+    return assignment
+
+def to_csr(assignment, n_clients, inds=None):
+    """
+    Compact representation of a partition: indices of client k are indices[offsets[k]:offsets[k+1]].
+    """
+    inds = np.arange(len(assignment)) if inds is None else inds
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=n_clients)))).astype(np.int64)
+    return offsets, inds[order].astype(np.int64)
+
+def partition(train_targets, val_targets, n_clients, scheme, param, seed=42):
+    """
+    Split the train-set among n_clients and the validation-set into a test-set for the server (half of it)
+    and validation-sets for the clients (the other half), following the same scheme.
+
+    Args:
+        train_targets (np.ndarray): Labels of the train-set
+        val_targets (np.ndarray): Labels of the validation-set
+        n_clients (int): Number of clients
+        scheme (str): One of 'iid' (uniformly at random, equal sizes), 'label' (skew as in partition_skewed, param = skew),
+            'dirichlet' (param = alpha), 'shards' (param = shards per client), 'quantity' (param = alpha)
+        param (float): Parameter of the scheme
+        seed (int, optional): Seed, same seed yields the same partition. Defaults to 42.
+
+    Returns:
+        dict: train_offsets, train_indices, val_offsets, val_indices and test_indices
+    """
+    if scheme not in SCHEMES:
+        raise ValueError('Unknown partitioning scheme: {}'.format(scheme))
+    rng = np.random.default_rng(seed)
+    train_targets, val_targets = np.asarray(train_targets, dtype=np.int64), np.asarray(val_targets, dtype=np.int64)
+    in_val = rng.random(len(val_targets)) < 0.5
+    val_inds, test_inds = np.flatnonzero(in_val), np.flatnonzero(~in_val)
+    val_targets = val_targets[val_inds]
+    n_classes = int(max(train_targets.max(), val_targets.max())) + 1
+
+    if scheme == 'shards':
+        owners = rng.permutation(n_clients * int(param)) // int(param)
+        train_assignment = assign_shards(train_targets, owners, rng)
+        val_assignment = assign_shards(val_targets, owners, rng)
+    elif scheme == 'quantity':
+        proportions = rng.dirichlet(np.full(n_clients, param))
+        train_assignment = assign_quantity(len(train_targets), proportions, rng)
+        val_assignment = assign_quantity(len(val_targets), proportions, rng)
+    elif scheme == 'iid':
+        train_assignment = assign_iid(len(train_targets), n_clients, rng)
+        val_assignment = assign_iid(len(val_targets), n_clients, rng)
+    else:
+        if scheme == 'dirichlet':
+            proportions = dirichlet_proportions(n_classes, n_clients, param, rng)
+        else:
+            proportions = label_skew_proportions(n_classes, n_clients, param)
+        train_assignment = assign_by_class(train_targets, proportions, rng)
+        val_assignment = assign_by_class(val_targets, proportions, rng)
+    # every client needs training samples and a validation set (probe set, before/after losses)
+    fill_empty(train_assignment, n_clients, rng)
+    fill_empty(val_assignment, n_clients, rng)
+
+    train_offsets, train_indices = to_csr(train_assignment, n_clients)
+    val_offsets, val_indices = to_csr(val_assignment, n_clients, val_inds)
+    return {
+        'train_offsets': train_offsets, 'train_indices': train_indices,
+        'val_offsets': val_offsets, 'val_indices': val_indices,
+        'test_indices': test_inds.astype(np.int64),
+    }
+
+def partition_dir(cache_dir, dataset, n_clients, scheme, param, seed):
+    return os.path.join(cache_dir, '{}_{}_{}_{}_{}_v{}'.format(dataset, n_clients, scheme, param, seed, VERSION))
+
+def save_partition(directory, parts):
+    # write into a temporary directory first and move it in place, s.t. readers never see partial files
+    tmp_dir = '{}.tmp{}'.format(directory.rstrip('/'), os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+    for name, arr in parts.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), arr)
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        shutil.rmtree(tmp_dir) # another process was faster
+
+def load_partition(directory):
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+            for name in ['train_offsets', 'train_indices', 'val_offsets', 'val_indices', 'test_indices']}
+
+def cached_partition(cache_dir, dataset, n_clients, scheme, param, seed, get_targets):
+    """
+    Load the partition for (dataset, n_clients, scheme, param, seed) from cache_dir or compute and store it.
+
+    Args:
+        get_targets (callable): Returns (train_targets, val_targets), only called on a cache miss
+
+    Returns:
+        dict: Memory-mapped arrays, see partition
+    """
+    directory = partition_dir(cache_dir, dataset, n_clients, scheme, param, seed)
+    if not os.path.exists(directory):
+        train_targets, val_targets = get_targets()
+        save_partition(directory, partition(train_targets, val_targets, n_clients, scheme, param, seed))
+    return load_partition(directory)
+
+def client_slice(parts, client_id, split='train'):
+    offsets = parts[split + '_offsets']
+    return np.asarray(parts[split + '_indices'][offsets[client_id]:offsets[client_id + 1]])
+
+
+if __name__ == '__main__':
+    targets = np.random.randint(0, 10, size=50000)
+    for scheme, param in [('iid', 0), ('label', 0.5), ('dirichlet', 0.5), ('shards', 2), ('quantity', 1.0)]:
+        start = time.time()
+        parts = partition(targets, targets, 10000, scheme, param)
+        print('{}: {:.3f}s for 10000 clients'.format(scheme, time.time() - start))
@@ -0,0 +1,144 @@
+import argparse
+import io
+import json
+import os
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from torchvision.datasets import ImageFolder
+from torchvision.io import decode_image, ImageReadMode
+
+
+def pack_image_folder(root, out_dir, shard_bytes=256 * 2**20):
+    """
+    Convert an ImageFolder-tree into a few large record shards: the encoded image files are concatenated
+    into shard_{k}.bin, index.npy holds (shard, offset, length) per sample and labels.npy the class-indices
+    (same order and class-indices as ImageFolder). The directory is walked once, here.
+
+    Args:
+        root (str): Root of the ImageFolder-tree (one sub-directory per class)
+        out_dir (str): Directory the shards are written to
+        shard_bytes (int, optional): Maximum size of a shard in bytes. Defaults to 256MB.
+    """
+    folder = ImageFolder(root)
+    os.makedirs(out_dir, exist_ok=True)
+    index, labels = np.zeros((len(folder.samples), 3), dtype=np.int64), np.zeros(len(folder.samples), dtype=np.int64)
+    shard, offset, out = 0, 0, open(os.path.join(out_dir, 'shard_0.bin'), 'wb')
+    for i, (path, label) in enumerate(folder.samples):
+        with open(path, 'rb') as f:
+            record = f.read()
+        if offset > 0 and offset + len(record) > shard_bytes:
+            out.close()
+            shard, offset = shard + 1, 0
+            out = open(os.path.join(out_dir, 'shard_{}.bin'.format(shard)), 'wb')
+        out.write(record)
+        index[i], labels[i] = (shard, offset, len(record)), label
+        offset += len(record)
+    out.close()
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    np.save(os.path.join(out_dir, 'labels.npy'), labels)
+    with open(os.path.join(out_dir, 'classes.json'), 'w') as f:
+        json.dump({'classes': folder.classes, 'shards': shard + 1}, f)
+
+def has_records(directory):
+    return directory is not None and os.path.exists(os.path.join(directory, 'classes.json'))
+
+class RecordDataset(Dataset):
+
+    def __init__(self, directory, transform=None, decode=False) -> None:
+        """
+        Map-style dataset over record shards written by pack_image_folder. Shards are memory-mapped
+        lazily (i.e. once per worker process), per-client subsets are obtained via Subset as usual.
+
+        Args:
+            directory (str): Directory holding the shards
+            transform (callable, optional): Applied to the PIL-image of a sample. Defaults to None.
+            decode (bool, optional): Return uint8-tensors (3, H, W) decoded by torchvision instead of PIL-images. Defaults to False.
+        """
+        self.directory = directory
+        self.transform = transform
+        self.decode = decode
+        self.index = np.load(os.path.join(directory, 'index.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(directory, 'labels.npy'))
+        with open(os.path.join(directory, 'classes.json'), 'r') as f:
+            meta = json.load(f)
+        self.classes, self.n_shards = meta['classes'], meta['shards']
+        self.shards = None
+
+    def __getstate__(self):
+        # memory-maps are not sent to worker processes, each worker maps the shards itself
+        state = self.__dict__.copy()
+        state['shards'] = None
+        return state
+
+    def record(self, index):
+        if self.shards is None:
+            self.shards = [np.memmap(os.path.join(self.directory, 'shard_{}.bin'.format(k)), dtype=np.uint8, mode='r')
+                           for k in range(self.n_shards)]
+        shard, offset, length = self.index[index]
+        return self.shards[shard][offset:offset + length]
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        record = self.record(index)
+        if self.decode:
+            img = decode_image(torch.from_numpy(np.array(record)), ImageReadMode.RGB)
+        else:
+            img = Image.open(io.BytesIO(record.tobytes())).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+class RecordStream(IterableDataset):
+
+    def __init__(self, dataset, indices=None, shuffle=True, chunk_size=256, seed=0) -> None:
+        """
+        Streaming reader over (a client's subset of) a RecordDataset. Samples are read in storage-order
+        in chunks of consecutive records, only the order of chunks and samples within a chunk is shuffled
+        (re-drawn every epoch), s.t. reads stay mostly sequential. Chunks are split among DataLoader-workers.
+
+        Args:
+            dataset (RecordDataset): Dataset to read from
+            indices (np.ndarray, optional): Subset of samples, e.g. from the partition-file. Defaults to None (all).
+            shuffle (bool, optional): Shuffle chunks and samples within chunks. Defaults to True.
+            chunk_size (int, optional): Number of consecutive records per chunk. Defaults to 256.
+            seed (int, optional): Seed of the shuffling. Defaults to 0.
+        """
+        self.dataset = dataset
+        indices = np.arange(len(dataset)) if indices is None else np.asarray(indices)
+        # storage-order = (shard, offset)
+        storage = dataset.index[indices]
+        self.indices = indices[np.lexsort((storage[:, 1], storage[:, 0]))]
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        # workers get a fresh copy every epoch, their shared base-seed (drawn per epoch by the DataLoader) tells epochs apart
+        rng = np.random.default_rng((self.seed, self.epoch if worker is None else worker.seed - worker.id))
+        self.epoch += 1
+        chunks = np.array_split(self.indices, max(1, int(np.ceil(len(self.indices) / self.chunk_size))))
+        order = rng.permutation(len(chunks)) if self.shuffle else np.arange(len(chunks))
+        if worker is not None:
+            order = order[worker.id::worker.num_workers]
+        for c in order:
+            chunk = rng.permutation(chunks[c]) if self.shuffle else chunks[c]
+            for index in chunk:
+                yield self.dataset[index]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack an ImageFolder-tree into record shards')
+    parser.add_argument('root', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--shard-mb', default=256, type=int)
+    args = parser.parse_args()
+    pack_image_folder(args.root, args.out_dir, args.shard_mb * 2**20)
@@ -6,6 +6,7 @@ from model_search import Network, TabularNetwork
 from model import NetworkCIFAR, NetworkImageNet, NetworkTabular
 import config
 from helpers import prepare_log_dirs
+from utils import compile_model, memory_format
 import argparse
 from genotypes import GENOTYPE
 
@@ -15,7 +16,9 @@ def start_server_search(rounds):
     if config.DATASET == 'fraud':
         net = TabularNetwork(config.NET_IN_DIMS, config.NET_OUT_DIMS, config.CLASSES, criterion, device=device)
     else:        
-        net = Network(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, criterion, device, in_channels=config.IN_CHANNELS, steps=config.NODE_NR)
+        net = Network(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, criterion, device, in_channels=config.IN_CHANNELS, steps=config.NODE_NR,
+                      partial_channels=config.PARTIAL_CHANNELS, fused=config.FUSED_MIXED_OP,
+                      sampled_ops=config.SAMPLED_OPS, checkpoint=config.CHECKPOINT)
 
     # prepare log-directories
     prepare_log_dirs()
@@ -24,7 +27,7 @@ def start_server_search(rounds):
     strategy = HANFStrategy(
         fraction_fit=0.5,
         fraction_eval=0.5,
-        initial_net=net,
+        initial_net=compile_model(net.to(memory_format=memory_format())),
         alpha=config.ALPHA,
         min_fit_clients=config.MIN_TRAIN_CLIENTS,
         min_eval_clients=config.MIN_VAL_CLIENTS,
@@ -43,9 +46,9 @@ def start_server_search(rounds):
 def start_server_valid(rounds):
     device = torch.device('cuda:{}'.format(str(config.SERVER_GPU))) 
     if config.DATASET == 'cifar10' or config.DATASET == 'fmnist':
-        net = NetworkCIFAR(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, False, GENOTYPE, device=device, in_channels=config.IN_CHANNELS)
+        net = NetworkCIFAR(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, False, GENOTYPE, device=device, in_channels=config.IN_CHANNELS, checkpoint=config.CHECKPOINT)
     elif config.DATASET == 'imagenet':
-        net = NetworkImageNet(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, False, GENOTYPE, device=device)
+        net = NetworkImageNet(config.OUT_CHANNELS, config.CLASSES, config.CELL_NR, False, GENOTYPE, device=device, checkpoint=config.CHECKPOINT)
     elif config.DATASET == 'fraud':
         net = NetworkTabular(config.NET_IN_DIMS, config.NET_OUT_DIMS, config.CLASSES, GENOTYPE, device=device)
 
@@ -56,7 +59,7 @@ def start_server_valid(rounds):
     strategy = HANFStrategy(
         fraction_fit=0.5,
         fraction_eval=0.5,
-        initial_net=net,
+        initial_net=compile_model(net.to(memory_format=memory_format())),
         alpha=config.ALPHA,
         min_fit_clients=config.MIN_TRAIN_CLIENTS,
         min_eval_clients=config.MIN_VAL_CLIENTS,
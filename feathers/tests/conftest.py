@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the search are imported flat, as when running from inside feathers/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import genotypes
+import operations
+
+
+@pytest.fixture
+def search_primitives(monkeypatch):
+    # PRIMITIVES still lists ops commented out in OPS (max_pool_3x3, dil_conv_*), restrict it to the available ones
+    monkeypatch.setattr(genotypes, 'PRIMITIVES', [p for p in genotypes.PRIMITIVES if p in operations.OPS])
+    import model_search
+    monkeypatch.setattr(model_search, 'PRIMITIVES', genotypes.PRIMITIVES)
+    return genotypes.PRIMITIVES
@@ -0,0 +1,24 @@
+import torch
+
+from architect import Architect
+from model_search import TabularNetwork
+
+
+def test_dominant_eigenvalues_match_dense_hessian():
+    torch.manual_seed(0)
+    net = TabularNetwork([7, 5, 3], [5, 3, 2], 2, torch.nn.BCELoss(), 'cpu').double()
+    arch_weight_decay = 1e-3
+    architect = Architect(net, 0.9, 3e-4, 3e-4, arch_weight_decay, 'cpu')
+    x, y = torch.randn(64, 7, dtype=torch.float64), torch.randint(0, 2, (64,)).double()
+    params = net.arch_parameters()
+    n = sum(p.numel() for p in params)
+    # as many Lanczos steps as arch-parameters: exact up to round-off
+    eigenvalues = architect.dominant_eigenvalues(x, y, k=3, steps=n)
+
+    # dense reference, one Hessian-vector product per unit vector
+    grad = torch.cat([g.view(-1) for g in torch.autograd.grad(net._loss(x, y), params, create_graph=True)])
+    hessian = torch.stack([torch.cat([h.view(-1) for h in torch.autograd.grad(grad, params, e, retain_graph=True)])
+                           for e in torch.eye(n, dtype=torch.float64)])
+    hessian = (hessian + hessian.t()) / 2 + arch_weight_decay * torch.eye(n, dtype=torch.float64)
+    reference = torch.linalg.eigvalsh(hessian).flip(0)[:3]
+    assert torch.allclose(torch.tensor(eigenvalues, dtype=torch.float64), reference, rtol=1e-6, atol=1e-8)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+import utils
+from genotypes import Genotype
+from model import NetworkCIFAR
+from model_search import Network
+
+pytestmark = pytest.mark.skipif(not utils._NON_REENTRANT_CHECKPOINT, reason='checkpointing needs torch >= 1.11')
+
+GENOTYPE = Genotype(normal=[('sep_conv_3x3', 1), ('skip_connect', 0), ('sep_conv_3x3', 2), ('avg_pool_3x3', 1),
+                            ('sep_conv_1x1', 3), ('sep_conv_3x3', 2), ('skip_connect', 2), ('sep_conv_3x3', 4)],
+                    normal_concat=range(2, 6),
+                    reduce=[('avg_pool_3x3', 1), ('sep_conv_3x3', 0), ('sep_conv_1x1', 2), ('sep_conv_3x3', 1),
+                            ('sep_conv_3x3', 3), ('skip_connect', 0), ('sep_conv_3x3', 3), ('sep_conv_3x3', 1)],
+                    reduce_concat=range(2, 6))
+
+
+def _step(kind, checkpoint):
+    # one forward/backward pass with drop-path, same seed for every checkpointing mode
+    torch.manual_seed(0)
+    criterion = torch.nn.CrossEntropyLoss()
+    if kind == 'search':
+        net = Network(8, 10, 3, criterion, 'cpu', checkpoint=checkpoint, drop_path_prob=0.3)
+    else:
+        net = NetworkCIFAR(8, 10, 3, False, GENOTYPE, 'cpu', checkpoint=checkpoint)
+        net.drop_path_prob = 0.3
+    x, y = torch.randn(8, 3, 16, 16), torch.randint(0, 10, (8,))
+    out = net(x)
+    out = out[0] if isinstance(out, tuple) else out
+    criterion(out, y).backward()
+    return out.detach(), net
+
+
+@pytest.mark.parametrize('kind', ['search', 'valid'])
+@pytest.mark.parametrize('checkpoint', ['cell', 'op'])
+def test_checkpointed_network_is_bit_identical(search_primitives, kind, checkpoint):
+    ref_out, ref = _step(kind, None)
+    out, net = _step(kind, checkpoint)
+    assert torch.equal(ref_out, out)
+    for a, b in zip(ref.parameters(), net.parameters()):
+        assert (a.grad is None) == (b.grad is None)
+        if a.grad is not None:
+            assert torch.equal(a.grad, b.grad)
+    # batch-norm statistics are updated once, not again by the recomputation
+    for a, b in zip(ref.state_dict().values(), net.state_dict().values()):
+        assert torch.equal(a, b)
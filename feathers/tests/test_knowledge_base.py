@@ -0,0 +1,31 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from knowledge_base import KnowledgeBase
+
+KEY = {'dataset': 'cifar10', 'clients': 2, 'skew': 0.0, 'model': 'Network_search', 'params': 1000}
+HYPERPARAMS = [{'learning_rate': 0.1 * (i + 1), 'momentum': 0.9} for i in range(4)]
+
+
+def _save(args):
+    file, run = args
+    rewards = np.arange(len(HYPERPARAMS), dtype=float) + run
+    KnowledgeBase(file).save_run('run_{}'.format(run), KEY, rewards, HYPERPARAMS, {1: [0.5], 3: [1.0, 2.0]}, top_k=1)
+
+
+def test_concurrent_runs_are_all_recorded(tmp_path):
+    file = str(tmp_path / 'knowledge_base.json')
+    # every run starts from the same (empty) view of the file and records itself twice
+    with multiprocessing.get_context('fork').Pool(8) as pool:
+        pool.map(_save, [(file, run) for run in range(16)] * 2)
+    with open(file) as f:
+        records = json.load(f)
+    assert sorted(r['run_id'] for r in records) == sorted('run_{}'.format(run) for run in range(16))
+    assert sorted(os.listdir(tmp_path)) == ['knowledge_base.json', 'knowledge_base.json.lock']
+
+    record = KnowledgeBase(file).nearest_runs(KEY, n=1)[0]
+    run = int(record['run_id'].split('_')[1])
+    assert record['best_configs'] == [{'config': HYPERPARAMS[3], 'reward': 3.0 + run, 'gains': [1.0, 2.0]}]
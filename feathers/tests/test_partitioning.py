@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from partitioning import (SCHEMES, assign_by_class, cached_partition, client_slice, dirichlet_proportions,
+                          label_skew_proportions, partition, to_csr)
+
+TARGETS = np.random.default_rng(0).integers(0, 10, size=50000)
+
+
+@pytest.mark.parametrize('scheme,param', [('iid', 0), ('label', 0.5), ('dirichlet', 0.5), ('shards', 2), ('quantity', 1.0)])
+@pytest.mark.parametrize('n_clients', [3, 3000])
+def test_partition_covers_all_samples_without_empty_clients(scheme, param, n_clients):
+    parts = partition(TARGETS, TARGETS[:20000], n_clients, scheme, param)
+    train = np.diff(parts['train_offsets'])
+    val = np.diff(parts['val_offsets'])
+    assert train.min() > 0 and val.min() > 0
+    assert np.array_equal(np.sort(parts['train_indices']), np.arange(len(TARGETS)))
+    held_out = np.concatenate([parts['val_indices'], parts['test_indices']])
+    assert np.array_equal(np.sort(held_out), np.arange(20000))
+
+
+@pytest.mark.parametrize('scheme,param', [('iid', 0), ('label', 0.0), ('label', 0.5)])
+def test_balanced_schemes_match_array_split_sizes(scheme, param):
+    # 50000 samples on 3000 clients: np.array_split yields 16 or 17 samples per client
+    train = np.diff(partition(TARGETS, TARGETS[:20000], 3000, scheme, param)['train_offsets'])
+    assert train.min() == 16 and train.max() == 17
+
+
+def test_assign_by_class_follows_proportions():
+    rng = np.random.default_rng(1)
+    proportions = dirichlet_proportions(10, 20, 0.5, rng)
+    assignment = assign_by_class(TARGETS, proportions, rng)
+    counts = np.zeros((10, 20))
+    np.add.at(counts, (TARGETS, assignment), 1)
+    expected = proportions * np.bincount(TARGETS, minlength=10)[:, None]
+    assert np.abs(counts - expected).max() <= 2
+    assert np.abs(counts.sum(axis=0) - expected.sum(axis=0)).max() <= 1
+
+
+def test_label_skew_proportions():
+    proportions = label_skew_proportions(10, 5, 1.0)
+    assert np.allclose(proportions.sum(axis=1), 1)
+    # two labels per client, each fully owned by it
+    assert np.array_equal(proportions.argmax(axis=1), np.arange(10) // 2)
+    assert np.allclose(label_skew_proportions(10, 5, 0.0), 0.2)
+
+
+def test_too_few_samples_for_clients():
+    with pytest.raises(ValueError):
+        partition(TARGETS, TARGETS[:100], 1000, 'iid', 0)
+
+
+def test_unknown_scheme():
+    assert 'legacy' not in SCHEMES
+    with pytest.raises(ValueError):
+        partition(TARGETS, TARGETS, 10, 'legacy', 0)
+
+
+def test_to_csr_round_trip():
+    assignment = np.random.default_rng(2).integers(0, 7, size=100)
+    offsets, indices = to_csr(assignment, 9)
+    assert offsets[-1] == 100 and offsets[-2] == offsets[-1] # clients 7 and 8 are empty
+    for k in range(9):
+        assert np.array_equal(indices[offsets[k]:offsets[k + 1]], np.flatnonzero(assignment == k))
+
+
+def test_cached_partition_is_reused_and_reproducible(tmp_path):
+    calls = []
+
+    def get_targets():
+        calls.append(1)
+        return TARGETS, TARGETS[:20000]
+
+    first = cached_partition(str(tmp_path), 'test', 10, 'label', 0.5, 42, get_targets)
+    second = cached_partition(str(tmp_path), 'test', 10, 'label', 0.5, 42, get_targets)
+    assert len(calls) == 1
+    fresh = partition(TARGETS, TARGETS[:20000], 10, 'label', 0.5, 42)
+    for k in range(10):
+        assert np.array_equal(client_slice(first, k), client_slice(second, k))
+        assert np.array_equal(client_slice(first, k, 'val'), client_slice(fresh, k, 'val'))
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+import config
+from model_search import Network
+from utils import autocast
+
+pytestmark = pytest.mark.skipif(not hasattr(torch, 'autocast'), reason='bf16 autocast needs torch >= 1.10')
+
+
+def _train(precision, monkeypatch, steps=4):
+    monkeypatch.setattr(config, 'PRECISION', precision)
+    torch.manual_seed(0)
+    criterion = torch.nn.CrossEntropyLoss()
+    net = Network(8, 10, 3, criterion, 'cpu')
+    optimizer = torch.optim.SGD(net.parameters(), 0.05, 0.9)
+    x, y = torch.randn(16, 3, 16, 16), torch.randint(0, 10, (16,))
+    for _ in range(steps):
+        optimizer.zero_grad()
+        with autocast('cpu'):
+            logits = net(x)
+        criterion(logits.float(), y).backward()
+        optimizer.step()
+    net.eval()
+    with torch.no_grad(), autocast('cpu'):
+        loss = criterion(net(x).float(), y).item()
+    return net, loss
+
+
+def test_bf16_matches_fp32_training(search_primitives, monkeypatch):
+    # fixed-seed run: bf16 forward passes track the fp32 losses, master weights and buffers stay float32
+    _, fp32_loss = _train('fp32', monkeypatch)
+    net, bf16_loss = _train('bf16', monkeypatch)
+    assert bf16_loss == pytest.approx(fp32_loss, rel=0.02)
+    assert all(v.dtype != torch.bfloat16 for v in net.state_dict().values())
+
+
+def test_fp32_is_no_op(monkeypatch):
+    monkeypatch.setattr(config, 'PRECISION', 'fp32')
+    with autocast('cpu'):
+        assert (torch.ones(2, 2) @ torch.ones(2, 2)).dtype == torch.float32
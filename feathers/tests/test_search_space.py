@@ -0,0 +1,84 @@
+import numpy as np
+import torch
+
+import zero_cost
+from model_search import Network, TabularNetwork, load_arch_masks
+from utils import prune_optimizer, weight_parameters
+
+
+def _batch(n=8, size=16):
+    return torch.randn(n, 3, size, size, dtype=torch.float64), torch.randint(0, 10, (n,))
+
+
+def test_fused_mixed_op_matches_mixed_op(search_primitives):
+    torch.manual_seed(0)
+    criterion = torch.nn.CrossEntropyLoss()
+    for partial_channels in [1, 2]:
+        plain = Network(8, 10, 3, criterion, 'cpu', partial_channels=partial_channels).double()
+        fused = Network(8, 10, 3, criterion, 'cpu', partial_channels=partial_channels, fused=True).double()
+        # same state-dict layout, s.t. both can be exchanged with the server
+        assert list(plain.state_dict()) == list(fused.state_dict())
+        fused.load_state_dict(plain.state_dict())
+        x, y = _batch()
+        for net in (plain, fused):
+            net._loss(x, y).backward()
+        for (name, a), b in zip(plain.named_parameters(), fused.parameters()):
+            if a.grad is not None:
+                assert torch.allclose(a.grad, b.grad, rtol=1e-9, atol=1e-12), name
+        for a, b in zip(plain.state_dict().values(), fused.state_dict().values()):
+            assert torch.allclose(a.double(), b.double(), rtol=1e-9, atol=1e-12)
+        plain.eval(), fused.eval()
+        with torch.no_grad():
+            assert torch.allclose(plain(x), fused(x), rtol=1e-9, atol=1e-12)
+
+
+def test_pruned_masks_round_trip(search_primitives):
+    torch.manual_seed(0)
+    criterion = torch.nn.CrossEntropyLoss()
+    server, client = Network(4, 10, 2, criterion, 'cpu'), Network(4, 10, 2, criterion, 'cpu')
+    optimizer = torch.optim.SGD(weight_parameters(client), 0.1, 0.9)
+    x, y = torch.randn(4, 3, 16, 16), torch.randint(0, 10, (4,))
+    client._loss(x, y).backward()
+    optimizer.step()
+    # server masks the two lowest-alpha ops of every edge and drops their weights
+    with torch.no_grad():
+        for alphas, mask in zip(server.arch_parameters(), server.arch_masks()):
+            mask.scatter_(1, alphas.argsort(dim=1)[:, :2], 0)
+    n_keys = len(server.state_dict())
+    assert server.prune_ops() > 0
+    assert len(server.state_dict()) < n_keys
+
+    # client takes over the masks from the sent parameters, after which both state-dicts line up again
+    parameters = [v.numpy() for v in server.state_dict().values()]
+    load_arch_masks(client, parameters)
+    prune_optimizer(optimizer, client)
+    assert list(client.state_dict()) == list(server.state_dict())
+    client.load_state_dict(dict(zip(client.state_dict().keys(), map(torch.as_tensor, parameters))), strict=True)
+    for a, b in zip(client.state_dict().values(), server.state_dict().values()):
+        assert torch.equal(a, b)
+    # momentum of the remaining weights is kept, the pruned ones are gone from the optimizer
+    alive = set(id(p) for p in weight_parameters(client))
+    assert set(id(p) for p in optimizer.param_groups[0]['params']) == alive
+    assert all(id(p) in alive for p in optimizer.state)
+    optimizer.zero_grad()
+    client._loss(x, y).backward()
+    optimizer.step()
+
+
+def test_score_ops_leaves_model_unchanged(search_primitives):
+    torch.manual_seed(0)
+    net = Network(4, 10, 3, torch.nn.CrossEntropyLoss(), 'cpu', steps=2, multiplier=2)
+    tabular = TabularNetwork([7, 5, 3], [5, 3, 2], 2, torch.nn.BCELoss(), 'cpu')
+    cases = [(net, (torch.randn(8, 3, 16, 16), torch.randint(0, 10, (8,)))),
+             (tabular, (torch.randn(16, 7), torch.randint(0, 2, (16,)).float()))]
+    for model, batch in cases:
+        for proxy in ['naswot', 'synflow', 'grad_norm']:
+            state = {k: v.clone() for k, v in model.state_dict().items()}
+            training = model.training
+            scores = zero_cost.score_ops(model, [batch], proxy, samples=4)
+            assert [s.shape for s in scores] == [tuple(a.shape) for a in model.arch_parameters()]
+            assert all(np.isfinite(s).all() for s in scores)
+            assert model.training == training
+            for k, v in model.state_dict().items():
+                assert torch.equal(state[k], v), (proxy, k)
+            assert all(p.grad is None or not p.grad.any() for p in model.parameters())
@@ -1,16 +1,29 @@
+import contextlib
+import inspect
 import os, sys
 import numpy as np
 import torch
+import torch.utils.checkpoint
 import shutil
 import torchvision.transforms as transforms
 from torch.autograd import Variable
-from torch.utils.data import random_split, Subset
+from torch.utils.data import random_split, Dataset, Subset, TensorDataset
 import torchvision
 import math
 import json
+import logging
+import time
+from scipy.stats import norm
 from fraud_detection import FraudDetectionData
+from partitioning import cached_partition, client_slice
+from augmentation import BatchAugment, AugmentedLoader, decode_rgb
+from records import RecordDataset, has_records
+import config
 
 class Loader:
+    name = None
+    train_augment = None # batch-level augmentations to apply after loading (see augmentation.AugmentedLoader)
+    val_augment = None
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
         self.n_clients = n_clients
@@ -23,6 +36,12 @@ class Loader:
         """
         Loads the Fashion-MNIST dataset
         """
+        if config.PARTITION_SCHEME != 'legacy':
+            parts = self._cached_partition()
+            self.train_partitions = [Subset(self.train_data, client_slice(parts, i, 'train')) for i in range(self.n_clients)]
+            self.val_partitions = [Subset(self.val_data, client_slice(parts, i, 'val')) for i in range(self.n_clients)]
+            self.test_set = Subset(self.val_data, np.asarray(parts['test_indices']))
+            return
         self.train_partitions, self.val_partitions, self.test_set, train_inds, val_inds, test_inds = partition_skewed(self.train_data, self.val_data, self.n_clients, skew=self.skew)
         train_dict, val_dict = {}, {}
         for i, inds in enumerate(train_inds):
@@ -37,21 +56,61 @@ class Loader:
         with open(self.indspath, 'w+') as f:
             json.dump(json_dict, f)
 
-    def load_client_data(self, client_id):
+    def _cached_partition(self):
+        param = {'dirichlet': config.PARTITION_ALPHA, 'quantity': config.PARTITION_ALPHA,
+                 'shards': config.PARTITION_SHARDS}.get(config.PARTITION_SCHEME, self.skew)
+        return cached_partition(config.PARTITION_CACHE_DIR, self.name, self.n_clients, config.PARTITION_SCHEME, param,
+                                config.PARTITION_SEED, lambda: (get_targets(self.train_data), get_targets(self.val_data)))
+
+    def client_indices(self, client_id):
+        if config.PARTITION_SCHEME != 'legacy':
+            parts = self._cached_partition()
+            return client_slice(parts, client_id, 'train'), client_slice(parts, client_id, 'val')
         with open(self.indspath, 'r') as f:
             inds_dict = json.load(f)
         train_inds = np.array(inds_dict['train'][str(client_id)])
         val_inds = np.array(inds_dict['val'][str(client_id)])
+        return train_inds, val_inds
+
+    def test_indices(self):
+        if config.PARTITION_SCHEME != 'legacy':
+            return np.asarray(self._cached_partition()['test_indices'])
+        with open(self.indspath, 'r') as f:
+            inds_dict = json.load(f)
+        return np.array(inds_dict['test'])
+
+    def load_client_data(self, client_id):
+        train_inds, val_inds = self.client_indices(client_id)
         trainset = Subset(self.train_data, train_inds)
         valset = Subset(self.val_data, val_inds)
         return trainset, valset
 
     def load_server_data(self):
-        with open(self.indspath, 'r') as f:
-            inds_dict = json.load(f)
-        test_inds = np.array(inds_dict['test'])
-        testset = Subset(self.val_data, test_inds)
+        testset = Subset(self.val_data, self.test_indices())
         return testset
+
+    def raw_arrays(self, train):
+        """
+        Samples and labels of the train- or validation-set as arrays (NCHW for images) as they are stored
+        by the dataset, i.e. without decoding or transforming single samples.
+        """
+        data = self.train_data if train else self.val_data
+        if isinstance(data, ArrayDataset):
+            return data.data, np.asarray(data.targets)
+        return self.to_arrays(data)
+
+    @staticmethod
+    def to_arrays(dataset):
+        raise ValueError('{} does not hold its data in arrays'.format(type(dataset).__name__))
+
+    def _load(self, name, build):
+        """
+        Build a dataset, or, if SHARED_DATA_DIR is set, attach to the read-only copy of its arrays
+        shared by all processes on this host (the first process to get here builds it).
+        """
+        if config.SHARED_DATA_DIR is None:
+            return build()
+        return ArrayDataset(*shared_arrays(name, lambda: self.to_arrays(build()), config.SHARED_DATA_DIR))
          
     def get_client_data(self):
         for train, val in zip(self.train_partitions, self.val_partitions):
@@ -61,22 +120,33 @@ class Loader:
         return self.test_set
 
 class FashionMNISTLoader(Loader):
+    name = 'fmnist'
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
         super().__init__(n_clients, indspath, skew)
         transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), torchvision.transforms.Normalize((0,), (1,))])
-        self.train_data = torchvision.datasets.FashionMNIST('../../../datasets/femnist/', download=True, train=True, transform=transform)
-        self.val_data = torchvision.datasets.FashionMNIST('../../../datasets/femnist/', download=True, train=False, transform=transform)
+        self.train_data = self._load('fmnist_train', lambda: torchvision.datasets.FashionMNIST('../../../datasets/femnist/', download=True, train=True, transform=transform))
+        self.val_data = self._load('fmnist_val', lambda: torchvision.datasets.FashionMNIST('../../../datasets/femnist/', download=True, train=False, transform=transform))
+
+    @staticmethod
+    def to_arrays(dataset):
+        return dataset.data.numpy()[:, None], dataset.targets.numpy()
 
 class CIFAR10Loader(Loader):
+    name = 'cifar10'
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
         super().__init__(n_clients, indspath, skew)
         transform = torchvision.transforms.Compose([torchvision.transforms.ToTensor(), torchvision.transforms.Normalize((0,), (1,))])
-        self.train_data = torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=True, transform=transform)
-        self.val_data = torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=False, transform=transform)
+        self.train_data = self._load('cifar10_train', lambda: torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=True, transform=transform))
+        self.val_data = self._load('cifar10_val', lambda: torchvision.datasets.CIFAR10('../../../datasets/cifar10/', download=True, train=False, transform=transform))
+
+    @staticmethod
+    def to_arrays(dataset):
+        return dataset.data.transpose(0, 3, 1, 2), np.array(dataset.targets)
 
 class ImageNet(Loader):
+    name = 'imagenet'
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
         super().__init__(n_clients, indspath, skew)
@@ -96,15 +166,43 @@ class ImageNet(Loader):
             transforms.ToTensor(),
             normalize,
         ])
-        self.train_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/train', transform=transform_train)
-        self.val_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/val', transform=transform_valid)
+        if config.BATCH_AUGMENT:
+            # decode to uint8-tensors only, crop/flip/jitter/normalize are applied on whole batches
+            self.train_augment, self.val_augment = BatchAugment(train=True), BatchAugment(train=False)
+            transform_train, transform_valid, loader = None, None, decode_rgb
+        else:
+            loader = torchvision.datasets.folder.default_loader
+        if has_records(config.IMAGENET_RECORD_DIR + 'train') and has_records(config.IMAGENET_RECORD_DIR + 'val'):
+            # packed shards (see records.py), no directory walk and no per-sample file opens
+            self.train_data = RecordDataset(config.IMAGENET_RECORD_DIR + 'train', transform=transform_train, decode=config.BATCH_AUGMENT)
+            self.val_data = RecordDataset(config.IMAGENET_RECORD_DIR + 'val', transform=transform_valid, decode=config.BATCH_AUGMENT)
+            return
+        self.train_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/train', transform=transform_train, loader=loader)
+        self.val_data = torchvision.datasets.ImageFolder('../../../datasets/tiny-imagenet/val', transform=transform_valid, loader=loader)
 
 class FraudDetection(Loader):
+    name = 'fraud'
 
     def __init__(self, n_clients, indspath, skew=0) -> None:
        super().__init__(n_clients, indspath, skew)
-       self.train_data = FraudDetectionData('../../../datasets/ccFraud/', train=True)
-       self.val_data = FraudDetectionData('../../../datasets/ccFraud/', train=False)
+       self.train_data = self._load('fraud_train', lambda: FraudDetectionData('../../../datasets/ccFraud/', train=True, fraction=config.FRAUD_FRACTION))
+       self.val_data = self._load('fraud_val', lambda: FraudDetectionData('../../../datasets/ccFraud/', train=False, fraction=config.FRAUD_FRACTION))
+
+    def load_client_data(self, client_id):
+        # only the rows of the client's partition are read from the memory-mapped columns
+        if isinstance(self.train_data, ArrayDataset):
+            return super().load_client_data(client_id)
+        train_inds, val_inds = self.client_indices(client_id)
+        return self.train_data.subset(train_inds), self.val_data.subset(val_inds)
+
+    def load_server_data(self):
+        if isinstance(self.val_data, ArrayDataset):
+            return super().load_server_data()
+        return self.val_data.subset(self.test_indices())
+
+    @staticmethod
+    def to_arrays(dataset):
+        return dataset.gather()
 
 
 def get_dataset_loder(dataset, num_clients, indspath, skew=0):
@@ -119,6 +217,315 @@ def get_dataset_loder(dataset, num_clients, indspath, skew=0):
     else:
         raise ValueError('{} is not supported'.format(dataset))
 
+class ArrayDataset(Dataset):
+
+    def __init__(self, data, targets) -> None:
+        """
+        Dataset over (possibly memory-mapped) arrays. uint8-images are scaled to [0, 1] like ToTensor does.
+        """
+        super().__init__()
+        self.data = data
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        x = torch.from_numpy(np.array(self.data[index]))
+        if x.dtype == torch.uint8:
+            x = x.float().div_(255)
+        return x, int(self.targets[index])
+
+def class_weights(targets):
+    """
+    Per-sample weights inversely proportional to the frequency of the sample's class.
+    """
+    targets = torch.as_tensor(np.asarray(targets), dtype=torch.long)
+    return (1.0 / torch.bincount(targets).double())[targets]
+
+def tensor_data(dataset):
+    """
+    (samples, labels) as tensors if the dataset (or a Subset of it) is held in memory as tensors
+    (tabular data, probe sets), else None.
+    """
+    if isinstance(dataset, Subset):
+        data = tensor_data(dataset.dataset)
+        if data is None:
+            return None
+        inds = torch.as_tensor(np.asarray(dataset.indices), dtype=torch.long)
+        return data[0][inds], data[1][inds]
+    if isinstance(dataset, TensorDataset) and len(dataset.tensors) == 2:
+        return dataset.tensors
+    if isinstance(getattr(dataset, 'X', None), torch.Tensor) and isinstance(getattr(dataset, 'y', None), torch.Tensor):
+        return dataset.X, dataset.y
+    return None
+
+class TensorBatchLoader:
+
+    def __init__(self, data, targets, batch_size, shuffle=False, sampler=None, drop_last=False) -> None:
+        """
+        Batch-level replacement of DataLoader for datasets held in memory as tensors: every batch is gathered
+        by one index-lookup in the main process, shuffling and weighted sampling are done on the index-tensor.
+
+        Args:
+            data (torch.Tensor): Samples
+            targets (torch.Tensor): Labels
+            batch_size (int): Batch size
+            shuffle (bool, optional): Draw a random permutation every epoch. Defaults to False.
+            sampler (WeightedRandomSampler, optional): Draw indices according to its weights instead. Defaults to None.
+            drop_last (bool, optional): Drop the last incomplete batch. Defaults to False.
+        """
+        self.dataset = TensorDataset(data, targets)
+        self.data, self.targets = data, targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.drop_last = drop_last
+
+    def _num_samples(self):
+        return len(self.data) if self.sampler is None else self.sampler.num_samples
+
+    def __len__(self):
+        n = self._num_samples()
+        return n // self.batch_size if self.drop_last else math.ceil(n / self.batch_size)
+
+    def __iter__(self):
+        if self.sampler is not None:
+            inds = torch.multinomial(self.sampler.weights, self.sampler.num_samples, self.sampler.replacement)
+        elif self.shuffle:
+            inds = torch.randperm(len(self.data))
+        else:
+            inds = torch.arange(len(self.data))
+        for batch in inds.split(self.batch_size):
+            if self.drop_last and len(batch) < self.batch_size:
+                break
+            yield self.data[batch], self.targets[batch]
+
+def make_loader(dataset, batch_size, shuffle=False, sampler=None, **kwargs):
+    """
+    TensorBatchLoader if the dataset is held in memory as tensors, else a DataLoader (kwargs are passed on).
+    """
+    data = tensor_data(dataset)
+    if data is not None:
+        return TensorBatchLoader(*data, batch_size, shuffle=shuffle, sampler=sampler)
+    return torch.utils.data.DataLoader(dataset, batch_size, shuffle=shuffle, sampler=sampler, **kwargs)
+
+class EndlessLoader:
+
+    def __init__(self, loader) -> None:
+        """
+        Endless stream over a loader: when an epoch is exhausted the loader is iterated again (and thus
+        reshuffled if it shuffles). With persistent workers no worker processes are started after the first epoch.
+        """
+        self.loader = loader
+        self.dataset = loader.dataset
+
+    def __iter__(self):
+        while True:
+            for batch in self.loader:
+                yield batch
+
+class DevicePrefetcher:
+
+    def __init__(self, loader, device) -> None:
+        """
+        Moves batches of a loader to device. On CUDA, the copy of the next batch is issued on a side-stream
+        while the current one is being used (double-buffering), s.t. training does not wait for host-to-device copies.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator):
+        batch = next(iterator, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [t.to(self.device, non_blocking=True) for t in batch]
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield [t.to(self.device) for t in batch]
+            return
+        iterator = iter(self.loader)
+        batch = self._preload(iterator)
+        while batch is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for t in batch:
+                t.record_stream(current) # memory must not be reused by the side-stream while still in use
+            next_batch = self._preload(iterator)
+            yield batch
+            batch = next_batch
+
+class MemoryFormatLoader:
+
+    def __init__(self, loader) -> None:
+        """
+        Converts the (image-)inputs of the batches of a loader to the configured memory format.
+        """
+        self.loader = loader
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for input, *rest in self.loader:
+            yield [input.contiguous(memory_format=memory_format()) if input.dim() == 4 else input] + rest
+
+def device_loader(loader, device, augment=None):
+    """
+    Prefetch batches of loader to device and apply a batch-level augmentation there (if given).
+    """
+    loader = DevicePrefetcher(loader, device)
+    loader = loader if augment is None else AugmentedLoader(loader, augment)
+    return MemoryFormatLoader(loader) if config.CHANNELS_LAST else loader
+
+def shared_arrays(name, build, shared_dir, timeout=3600):
+    """
+    Attach to a read-only, memory-mapped copy of a dataset's (samples, labels)-arrays in shared_dir
+    (e.g. on /dev/shm), s.t. co-located processes share a single copy. The first process creates the
+    copy by calling build(), all others wait until it has been published and memory-map it.
+
+    Args:
+        name (str): Name of the arrays, e.g. 'cifar10_train'
+        build (callable): Returns (samples, labels) as numpy-arrays
+        shared_dir (str): Directory holding the shared copies
+        timeout (int, optional): Seconds to wait for another process building the copy. Defaults to 3600.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Memory-mapped samples and labels
+    """
+    if not os.path.exists(shared_dir):
+        os.makedirs(shared_dir, exist_ok=True)
+    data_file, targets_file = os.path.join(shared_dir, name + '_x.npy'), os.path.join(shared_dir, name + '_y.npy')
+    lock_file, start = os.path.join(shared_dir, name + '.lock'), time.time()
+    # per-process names, a (wrongly) concurrent builder can never tear another one's copy
+    tmp = '.{}.tmp.npy'.format(os.getpid())
+    while not os.path.exists(targets_file):
+        if not _acquire_lock(lock_file):
+            if not _lock_alive(lock_file):
+                _remove_stale_lock(lock_file) # builder died, take over
+            elif time.time() - start > timeout:
+                raise TimeoutError('Waiting for {} timed out'.format(data_file))
+            time.sleep(1)
+            continue
+        try:
+            data, targets = build()
+            # publish atomically, labels last since their existence marks the copy as complete
+            np.save(data_file + tmp, np.ascontiguousarray(data))
+            os.replace(data_file + tmp, data_file)
+            np.save(targets_file + tmp, np.ascontiguousarray(targets).astype(np.int64))
+            os.replace(targets_file + tmp, targets_file)
+        finally:
+            _release_lock(lock_file)
+    return np.load(data_file, mmap_mode='r'), np.load(targets_file, mmap_mode='r')
+
+def _acquire_lock(lock_file):
+    # the pid is written to a private file which is then hard-linked into place,
+    # s.t. the lock never exists without the pid of its owner
+    own = '{}.{}'.format(lock_file, os.getpid())
+    with open(own, 'w') as f:
+        f.write(str(os.getpid()))
+    try:
+        os.link(own, lock_file)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(own)
+
+def _lock_owner(lock_file):
+    try:
+        with open(lock_file, 'r') as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _lock_alive(lock_file):
+    pid = _lock_owner(lock_file)
+    if pid is None:
+        return True # released in the meantime, acquiring is retried
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _remove_stale_lock(lock_file):
+    # the stale lock is moved aside first, if another waiter replaced it in the meantime by a live one, it is put back
+    stale = '{}.stale.{}'.format(lock_file, os.getpid())
+    try:
+        os.rename(lock_file, stale)
+    except FileNotFoundError:
+        return
+    if _lock_alive(stale):
+        try:
+            os.link(stale, lock_file)
+        except FileExistsError:
+            pass
+    os.remove(stale)
+
+def _release_lock(lock_file):
+    if _lock_owner(lock_file) == os.getpid():
+        os.remove(lock_file)
+
+def export_shards(loader, shard_dir):
+    """
+    Write the train/val partition of every client and the server's test partition as contiguous
+    arrays into .npy-files (plus a manifest), s.t. they can be memory-mapped by load_client_shards/load_server_shards.
+    Must be called after loader.partition().
+
+    Args:
+        loader (Loader): Loader the data has been partitioned with
+        shard_dir (str): Directory the shards are written to
+    """
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    train_x, train_y = loader.raw_arrays(train=True)
+    val_x, val_y = loader.raw_arrays(train=False)
+
+    def _write(name, x, y, inds):
+        np.save(os.path.join(shard_dir, name + '_x.npy'), np.ascontiguousarray(x[inds]))
+        np.save(os.path.join(shard_dir, name + '_y.npy'), np.ascontiguousarray(y[inds]).astype(np.int64))
+        return len(inds)
+
+    manifest = {'dtype': str(train_x.dtype), 'sample_shape': list(train_x.shape[1:]), 'clients': {}}
+    for client_id in range(loader.n_clients):
+        train_inds, val_inds = loader.client_indices(client_id)
+        manifest['clients'][str(client_id)] = {
+            'train': _write('client_{}_train'.format(client_id), train_x, train_y, train_inds),
+            'val': _write('client_{}_val'.format(client_id), val_x, val_y, val_inds),
+        }
+    manifest['test'] = _write('test', val_x, val_y, loader.test_indices())
+    with open(os.path.join(shard_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+def _load_shard(shard_dir, name):
+    x = np.load(os.path.join(shard_dir, name + '_x.npy'), mmap_mode='r')
+    y = np.load(os.path.join(shard_dir, name + '_y.npy'), mmap_mode='r')
+    return ArrayDataset(x, y)
+
+def load_client_shards(shard_dir, client_id):
+    return _load_shard(shard_dir, 'client_{}_train'.format(client_id)), _load_shard(shard_dir, 'client_{}_val'.format(client_id))
+
+def load_server_shards(shard_dir):
+    return _load_shard(shard_dir, 'test')
+
 def partition_data(train_set, val_set, n_clients):
     train_len = len(train_set)
     val_len = len(val_set) // 2
@@ -225,10 +632,141 @@ def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
             val_subs_inds.append(indices)
     return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
 
+def weight_parameters(model):
+    """
+    Parameters of a network without its architecture parameters (alphas, betas) if it has any. The weight
+    optimizer of the search stage is built over these only, the architecture is updated by the Architect alone.
+    """
+    arch = set(id(a) for a in model.arch_parameters()) if hasattr(model, 'arch_parameters') else set()
+    return [p for p in model.parameters() if id(p) not in arch]
+
+def prune_optimizer(optimizer, model):
+    """
+    Drop parameters no longer part of the model's weights (e.g. of pruned ops) from an optimizer's param-groups and
+    state, keeping the state (e.g. momentum) of the remaining ones.
+    """
+    alive = set(id(p) for p in weight_parameters(model))
+    for group in optimizer.param_groups:
+        removed = [p for p in group['params'] if id(p) not in alive]
+        group['params'] = [p for p in group['params'] if id(p) in alive]
+        for p in removed:
+            optimizer.state.pop(p, None)
+
+def compile_model(model):
+    """
+    Opt-in compilation (config.COMPILE) of the forward pass of a network with torch.compile. The module is compiled
+    in place, s.t. its state-dict (and thus the federated parameters) keeps its keys. Compiled graphs are cached in
+    config.COMPILE_CACHE_DIR and reused after restarts, code that can't be compiled runs eagerly. Models with hooks
+    (e.g. per-sample gradients for DP) are left uncompiled.
+    """
+    if not config.COMPILE:
+        return model
+    if not hasattr(model, 'compile'):
+        logging.warning('COMPILE needs torch >= 2.2 (installed: %s), running eagerly', torch.__version__)
+        return model
+    if any(m._forward_hooks or m._forward_pre_hooks or m._backward_hooks for m in model.modules()):
+        logging.warning('Compilation not supported for models with hooks, running eagerly')
+        return model
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath(config.COMPILE_CACHE_DIR))
+    import torch._dynamo
+    import torch._inductor.config
+    torch._inductor.config.fx_graph_cache = True
+    torch._dynamo.config.suppress_errors = True # fall back to eager execution if compilation fails
+    model.compile()
+    return model
+
+def memory_format():
+    """
+    Memory format of the conv-weights and input batches: channels-last (NHWC) if config.CHANNELS_LAST, else unchanged.
+    Parameters are always sent in the canonical (contiguous) layout, see get_parameters of the clients.
+    """
+    return torch.channels_last if config.CHANNELS_LAST else torch.preserve_format
+
+def autocast(device):
+    """
+    Context for the forward passes of training and evaluation: bfloat16 autocast if config.PRECISION == 'bf16',
+    no-op otherwise. Weights, gradients and batch-norm statistics (and thus all parameters sent) stay float32.
+    """
+    if config.PRECISION != 'bf16':
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('PRECISION = \'bf16\' needs torch >= 1.10 (installed: {})'.format(torch.__version__))
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()
 
+def get_targets(dataset):
+    """
+    Obtain the labels of a dataset (or of a Subset of it) as numpy-array without loading any samples.
+    """
+    if isinstance(dataset, Subset):
+        return get_targets(dataset.dataset)[np.asarray(dataset.indices)]
+    targets = dataset.y if hasattr(dataset, 'y') else dataset.targets
+    if isinstance(targets, torch.Tensor):
+        targets = targets.cpu().numpy()
+    return np.asarray(targets)
+
+def stratified_sample(targets, size, rng):
+    """
+    Draw a random sample of positions of size `size` whose label distribution matches the one of `targets`
+    (proportional allocation, remaining slots go to the labels with the largest fractional allocation).
+
+    Args:
+        targets (np.ndarray): Labels of the population
+        size (int): Sample size
+        rng (np.random.Generator): Random generator used for sampling
+
+    Returns:
+        np.ndarray: Sorted positions (w.r.t. targets) of the sampled elements
+    """
+    size = min(size, len(targets))
+    labels, counts = np.unique(targets, return_counts=True)
+    exact = size * counts / len(targets)
+    alloc = np.floor(exact).astype(int)
+    alloc[np.argsort(alloc - exact)[:size - alloc.sum()]] += 1
+    # random order within each label, labels in contiguous blocks
+    perm = rng.permutation(len(targets))
+    perm = perm[np.argsort(np.asarray(targets)[perm], kind='stable')]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.sort(np.concatenate([perm[s:s+a] for s, a in zip(starts, alloc)]))
+
+def build_probe_set(dataset, size, seed=0):
+    """
+    Materialize a fixed stratified subset of `dataset` as contiguous tensors. Used by clients to
+    measure their before/after gain losses on a small, fixed set instead of the whole validation set.
+
+    Args:
+        dataset (Dataset): (Subset of a) dataset to sample from
+        size (int): Size of the probe set
+        seed (int, optional): Seed of the sample. Defaults to 0.
+
+    Returns:
+        TensorDataset: Probe set
+    """
+    inds = stratified_sample(get_targets(dataset), size, np.random.default_rng(seed))
+    feats, labels = zip(*[dataset[int(i)] for i in inds])
+    return TensorDataset(torch.stack(feats).contiguous(), torch.as_tensor([int(l) for l in labels]))
+
+def sample_size_for_ci(half_width, population, confidence=0.95, p=0.5):
+    """
+    Number of samples needed s.t. the normal-approximation confidence interval of an accuracy p
+    has the given half-width (including the finite population correction).
+    """
+    z = norm.ppf(0.5 + confidence / 2)
+    n0 = z ** 2 * p * (1 - p) / half_width ** 2
+    return int(min(population, np.ceil(n0 / (1 + (n0 - 1) / population))))
+
+def accuracy_ci(accuracy, n, population, confidence=0.95):
+    """
+    Half-width of the normal-approximation confidence interval of an accuracy measured on n of population samples.
+    """
+    if n >= population:
+        return 0.0
+    z = norm.ppf(0.5 + confidence / 2)
+    return float(z * np.sqrt(accuracy * (1 - accuracy) / n * (population - n) / (population - 1)))
+
 class AvgrageMeter(object):
 
   def __init__(self):
@@ -244,6 +782,28 @@ class AvgrageMeter(object):
     self.cnt += n
     self.avg = self.sum / self.cnt
 
+class ThroughputMeter(object):
+
+  def __init__(self, momentum=0.5):
+    self.momentum = momentum
+    self.sec_per_step = None
+
+  def update(self, seconds, steps):
+    if steps == 0:
+      return
+    sec_per_step = seconds / steps
+    if self.sec_per_step is None:
+      self.sec_per_step = sec_per_step
+    else:
+      self.sec_per_step = self.momentum * self.sec_per_step + (1 - self.momentum) * sec_per_step
+
+  def steps_within(self, budget, min_steps=1, max_steps=None):
+    """number of steps that fit into budget seconds, max_steps as long as the throughput is unknown"""
+    if self.sec_per_step is None:
+      return max_steps
+    steps = max(min_steps, int(budget / self.sec_per_step))
+    return steps if max_steps is None else min(steps, max_steps)
+
 class CrossEntropyLabelSmooth(torch.nn.Module):
 
   def __init__(self, num_classes, epsilon):
@@ -295,6 +855,39 @@ def load(model, model_path):
   model.load_state_dict(torch.load(model_path))
 
 
+# non-reentrant checkpointing (needed for torch.autograd.grad in the architect) exists from torch 1.11 on
+_NON_REENTRANT_CHECKPOINT = 'use_reentrant' in inspect.signature(torch.utils.checkpoint.checkpoint).parameters
+
+def checkpointed(module, *args):
+  """
+  Evaluate module(*args) with activation checkpointing: only the inputs are kept for the backward pass, the
+  forward is recomputed during backward with the RNG-state of the first pass (same drop-path masks). Running
+  statistics of batch-norms are updated by the first pass only. On torch < 1.11 the module runs without
+  checkpointing (with a warning), see _NON_REENTRANT_CHECKPOINT.
+  """
+  if not _NON_REENTRANT_CHECKPOINT:
+    if not getattr(checkpointed, 'warned', False):
+      logging.warning('CHECKPOINT needs torch >= 1.11 (installed: %s), running without checkpointing', torch.__version__)
+      checkpointed.warned = True
+    return module(*args)
+  recompute = []
+  def run(*args):
+    if not recompute:
+      recompute.append(True)
+      return module(*args)
+    bns = [m for m in module.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    stats = [(bn.running_mean.clone(), bn.running_var.clone(), bn.num_batches_tracked.clone()) for bn in bns]
+    try:
+      return module(*args)
+    finally:
+      # also reached if the recomputation is stopped early, once all needed activations are restored
+      with torch.no_grad():
+        for bn, (mean, var, n) in zip(bns, stats):
+          bn.running_mean.copy_(mean)
+          bn.running_var.copy_(var)
+          bn.num_batches_tracked.copy_(n)
+  return torch.utils.checkpoint.checkpoint(run, *args, use_reentrant=False, preserve_rng_state=True)
+
 def drop_path(x, drop_prob, device):
   if drop_prob > 0.:
     keep_prob = 1.-drop_prob
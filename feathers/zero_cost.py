@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+from copy import deepcopy
+from model_search import MixedOp, TabularMixedOp
+
+
+def grad_norm(model, input, target):
+    """
+    Norm of the gradient of the training loss w.r.t. the network weights.
+    """
+    weights = _weights(model)
+    grads = torch.autograd.grad(model._loss(input, target), weights, allow_unused=True)
+    return sum(g.norm().item() for g in grads if g is not None)
+
+def naswot(model, input, target):
+    """
+    NASWOT (Mellor et al., 2021): log-determinant of the kernel of binary activation codes of a batch,
+    the codes being the signs of the outputs of all mixed operations.
+    """
+    codes = []
+    hooks = [m.register_forward_hook(lambda m, i, o: codes.append((o.detach().view(o.size(0), -1) > 0).float()))
+             for m in model.modules() if isinstance(m, (MixedOp, TabularMixedOp))]
+    with torch.no_grad():
+        model(input)
+    for h in hooks:
+        h.remove()
+    codes = torch.cat(codes, dim=1)
+    kernel = codes @ codes.t() + (1 - codes) @ (1 - codes).t()
+    return torch.slogdet(kernel.double())[1].item()
+
+def synflow(model, input, target):
+    """
+    SynFlow (Tanaka et al., 2020): sum of |theta * dR/dtheta| with R the output of the linearized network
+    (absolute weights) for an all-ones input.
+    """
+    weights = _weights(model)
+    signs = [torch.sign(w.data) for w in weights]
+    for w in weights:
+        w.data.abs_()
+    model.eval()
+    output = model(torch.ones_like(input[:1])).sum()
+    grads = torch.autograd.grad(output, weights, allow_unused=True)
+    score = sum((w * g).abs().sum().item() for w, g in zip(weights, grads) if g is not None)
+    for w, sign in zip(weights, signs):
+        w.data.mul_(sign)
+    return score
+
+PROXIES = {'grad_norm': grad_norm, 'naswot': naswot, 'synflow': synflow}
+
+def _weights(model):
+    arch = set(id(a) for a in model.arch_parameters())
+    return [p for p in model.parameters() if id(p) not in arch]
+
+def score_ops(model, batches, proxy='naswot', samples=32, seed=0):
+    """
+    Training-free scores of the candidate operations of a supernet. Single-path architectures (one active op
+    per edge) are sampled by setting the op-masks one-hot, scored by the proxy on the given batches and
+    standardized over all samples. The score of an op on an edge is the mean standardized score of the sampled
+    architectures that use it. The model (weights, BN-statistics, masks) is left unchanged.
+
+    Args:
+        model (Network or TabularNetwork): Supernet
+        batches (list): (input, target)-batches to compute the proxy on
+        proxy (str, optional): 'naswot', 'synflow' or 'grad_norm'. Defaults to 'naswot'.
+        samples (int, optional): Number of sampled architectures. Defaults to 32.
+        seed (int, optional): Seed for sampling. Defaults to 0.
+
+    Returns:
+        list: One score-array per arch-parameter (same shape), 0 for ops never sampled or masked.
+    """
+    rng = np.random.default_rng(seed)
+    state = deepcopy(model.state_dict())
+    training = model.training
+    masks = model.arch_masks()
+    original = [m.clone() for m in masks]
+    choices, scores = [], []
+    for _ in range(samples):
+        sample = []
+        for mask, orig in zip(masks, original):
+            active = orig.cpu().numpy() > 0
+            choice = np.array([rng.choice(np.flatnonzero(row)) for row in active])
+            one_hot = torch.zeros_like(orig)
+            one_hot[torch.arange(len(choice)), torch.as_tensor(choice)] = 1
+            mask.copy_(one_hot)
+            sample.append(choice)
+        model.train()
+        scores.append(np.mean([PROXIES[proxy](model, x, y) for x, y in batches]))
+        choices.append(sample)
+    model.load_state_dict(state)
+    model.train(training)
+
+    scores = np.array(scores)
+    finite = np.isfinite(scores)
+    # degenerate architectures (e.g. singular NASWOT-kernel) rank last
+    scores = np.where(finite, scores, scores[finite].min() if finite.any() else 0.0)
+    scores = (scores - scores.mean()) / (scores.std() + 1e-12)
+    op_scores = []
+    for k, orig in enumerate(original):
+        total, count = np.zeros(tuple(orig.shape)), np.zeros(tuple(orig.shape))
+        rows = np.arange(orig.shape[0])
+        for sample, score in zip(choices, scores):
+            total[rows, sample[k]] += score
+            count[rows, sample[k]] += 1
+        op_scores.append(np.where(count > 0, total / np.maximum(count, 1), 0.0))
+    return op_scores
+
+def apply_scores(model, scores, keep=0, bias=0.0):
+    """
+    Reduce/bias the search space of a supernet by aggregated op-scores: on every edge only the keep best
+    (still active) ops stay unmasked, and the alphas are shifted by bias times the row-wise standardized scores.
+
+    Args:
+        model (Network or TabularNetwork): Supernet, modified in place
+        scores (list): One score-array per arch-parameter
+        keep (int, optional): Number of ops to keep per edge, 0 = no pruning. Defaults to 0.
+        bias (float, optional): Scale of the alpha-shift, 0 = alphas unchanged. Defaults to 0.0.
+    """
+    with torch.no_grad():
+        for alphas, mask, score in zip(model.arch_parameters(), model.arch_masks(), scores):
+            score = torch.as_tensor(np.asarray(score), dtype=alphas.dtype, device=alphas.device).view_as(alphas)
+            score = score.masked_fill(mask == 0, float('-inf'))
+            if 0 < keep < mask.shape[1]:
+                top = torch.topk(score, keep, dim=1).indices
+                mask.copy_(torch.zeros_like(mask).scatter_(1, top, 1) * mask)
+            if bias > 0:
+                active = mask > 0
+                finite = torch.where(active, score, torch.zeros_like(score))
+                n = active.sum(dim=1, keepdim=True).clamp(min=1)
+                mean = finite.sum(dim=1, keepdim=True) / n
+                std = (((finite - mean) * active) ** 2).sum(dim=1, keepdim=True).div(n).sqrt()
+                alphas.add_(bias * torch.where(active, (finite - mean) / (std + 1e-12), torch.zeros_like(score)))
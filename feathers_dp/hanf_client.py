@@ -9,7 +9,7 @@ import torch.nn as nn
 from torch.utils.data import DataLoader, WeightedRandomSampler
 from torch.autograd import Variable
 import numpy as np
-from utils import get_dataset_loder, get_params
+from utils import get_dataset_loder, get_params, endless
 from rtpt import RTPT
 import config
 from hyperparameters import Hyperparameters
@@ -60,14 +60,15 @@ def train(train_queue, valid_queue, model, architect, criterion, optimizer, lr,
        
        with BatchMemoryManager(data_loader=valid_queue,
                max_physical_batch_size=config.BATCH_SIZE, optimizer=architect.optimizer) as valid_bmm:
+            search_queue = endless(valid_bmm) # iterator is created once, not for every step
             for step, (input, target) in enumerate(train_bmm):
                 model.train()
 
                 input = input.to(device, non_blocking=True)
                 target = target.to(device, non_blocking=True)
 
-                # get a random minibatch from the search queue with replacement
-                input_search, target_search = next(iter(valid_bmm))
+                # get the next minibatch from the (endless, reshuffling) search queue
+                input_search, target_search = next(search_queue)
                 input_search = input_search.to(device, non_blocking=True)
                 target_search = target_search.to(device, non_blocking=True)
 
@@ -141,8 +142,8 @@ def main(dataset, num_clients, device, client_id, classes=10, cell_nr=4, input_c
                 {'params': model_params, 'lr': 0.01, 'weight_decay': 3e-4, 'momentum': 0.9},
                 {'params': arch_params, 'lr': 3e-4, 'weight_decay': 1e-3, 'momentum': 0.9}], lr=0.01, momentum=0.9, weight_decay=3e-4)
             sampler = self._get_sampler(train_data) if config.USE_WEIGHTED_SAMPLER else None
-            self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, sampler=sampler, num_workers=2)
-            self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2)
+            self.train_loader = DataLoader(train_data, config.BATCH_SIZE, pin_memory=True, sampler=sampler, num_workers=2, persistent_workers=True)
+            self.val_loader = DataLoader(test_data, config.BATCH_SIZE, pin_memory=True, num_workers=2, persistent_workers=True)
             #self.model = ModuleValidator.fix(self.model) # required to replace modules not supported by opacus (e.g. BatchNorm)
             #ModuleValidator.validate(self.model, strict=False)
             pe = PrivacyEngine()
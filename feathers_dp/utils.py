@@ -211,6 +211,12 @@ def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
             val_subs_inds.append(indices)
     return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
 
+def endless(loader):
+    # iterate a loader again and again, a new epoch (and thus a new shuffling/sampling) starts when one is exhausted
+    while True:
+        for batch in loader:
+            yield batch
+
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()
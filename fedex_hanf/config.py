@@ -23,10 +23,23 @@ PORT = '8005'
 GPUS = [0, 5, 6] # GPUs to use
 SERVER_GPU = 6
 
+# local work
+ROUND_DEADLINE = 0 # seconds a client may spend in fit, local steps are chosen to meet it (0 = fixed number of epochs)
+MIN_LOCAL_STEPS = 1 # min. number of local steps per round (deadline mode)
+MAX_LOCAL_EPOCHS = 10 # max. number of passes over the local data per round (deadline mode)
+
+# client gain measurement
+PROBE_SIZE = 0 # size of the fixed stratified validation subset used for before/after losses, their mean over batches is reported (0 = whole validation set, summed losses as before)
+PROBE_BATCH_SIZE = 256 # batch size used for evaluating the probe set
+
 DATA_SKEW = 0.0 # skew of labels. 0 = no skew, 1 only some clients hold some labels
 
 # validation stage
 DROP_PATH_PROB = 0.3 # probability of dropping a path in cell, similar to dropout
 
+# runtime
+PRECISION = 'fp32' # 'fp32' or 'bf16' (bfloat16 autocast of forward passes, weights and parameters sent stay float32)
+CHANNELS_LAST = False # channels-last (NHWC) memory format of conv-networks and input batches, faster depthwise-convs on CPU
+
 DATASET_INDS_FILE = f'./hyperparam-logs/search_DARTS_{DATASET}_{CLIENT_NR}_{DATA_SKEW}.csv'
 HYPERPARAM_FILE = './hyperparam-logs/indices.json'
\ No newline at end of file
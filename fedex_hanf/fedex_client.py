@@ -6,7 +6,7 @@ import flwr as fl
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from utils import get_dataset_loder
+from utils import get_dataset_loder, build_probe_set, ThroughputMeter, autocast, memory_format
 from fedex_model import FMNISTCNN, CIFARCNN, NetworkCIFAR, NetworkImageNet
 from rtpt import RTPT
 import numpy as np
@@ -14,26 +14,33 @@ from tensorboardX import SummaryWriter
 from datetime import datetime as dt
 import config
 import argparse
+import time
 from hyperparameters import Hyperparameters
 from genotype import GENOTYPE
 
 warnings.filterwarnings("ignore", category=UserWarning)
 EPOCHS = 5
 
-def train(net, trainloader, writer, epoch, optimizer, device):
-    """Train the network on the training set."""
+def train(net, trainloader, writer, epoch, optimizer, device, max_steps=None, stop_at=None):
+    """Train the network on the training set. Returns the number of steps done."""
     criterion = torch.nn.CrossEntropyLoss()
     running_loss = 0
+    steps = 0
     for i, (images, labels) in enumerate(trainloader):
-        images, labels = images.to(device), labels.to(device)
+        if (max_steps is not None and steps >= max_steps) or (stop_at is not None and steps > 0 and time.time() >= stop_at):
+            break
+        images, labels = images.to(device, memory_format=memory_format()), labels.to(device)
         optimizer.zero_grad()
-        logits, _ = net(images)
+        with autocast(device):
+            logits, _ = net(images)
         #writer.add_histogram('logits', logits, i*epoch)
-        loss = criterion(logits, labels)
+        loss = criterion(logits.float(), labels)
         loss.backward()
         nn.utils.clip_grad_norm_(net.parameters(), 5.)
         running_loss += loss.item()
         optimizer.step()
+        steps += 1
+    return steps
     # writer.add_scalar('Training_Loss', running_loss, epoch)
 
 def _test(net, testloader, device):
@@ -45,8 +52,10 @@ def _test(net, testloader, device):
         for feats, labels in testloader:
             #feats = feats.type(torch.FloatTensor)
             #labels = labels.type(torch.LongTensor)
-            feats, labels = feats.to(device), labels.to(device)
-            preds, _ = net(feats)
+            feats, labels = feats.to(device, memory_format=memory_format()), labels.to(device)
+            with autocast(device):
+                preds, _ = net(feats)
+            preds = preds.float()
             loss += criterion(preds, labels).item()
             _, predicted = torch.max(preds.data, 1)
             total += labels.size(0)
@@ -71,12 +80,17 @@ def main(device, client_id):
         net = NetworkCIFAR(config.OUT_CHANNELS, config.CLASSES, config.CELLS, False, GENOTYPE, device, config.IN_CHANNELS)
     else:
         net = NetworkImageNet(config.OUT_CHANNELS, config.CLASSES, config.CELLS, False, GENOTYPE, device=device)
-    net = net.to(device)
+    net = net.to(device, memory_format=memory_format())
 
     # Load data
     dataset_loader = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
     train_data, test_data = dataset_loader.load_client_data(client_id)
+    if config.PROBE_SIZE > 0:
+        probe = build_probe_set(test_data, config.PROBE_SIZE, seed=client_id)
+        probe_data = DataLoader(probe, config.PROBE_BATCH_SIZE)
     train_data, test_data = DataLoader(train_data, config.BATCH_SIZE, False, num_workers=2), DataLoader(test_data, config.BATCH_SIZE, False, num_workers=2)
+    if config.PROBE_SIZE == 0:
+        probe, probe_data = test_data.dataset, test_data
     rtpt = RTPT('JS', 'FedEx_Client', config.ROUNDS)
     rtpt.start()
 
@@ -92,9 +106,11 @@ def main(device, client_id):
             self.hyperparameters.read_from_csv(config.HYPERPARAM_FILE)
             self.optim = torch.optim.SGD(net.parameters(), 0.01, momentum=0.9, weight_decay=1e-4)
             self.epoch = 1
+            self.throughput = ThroughputMeter()
 
         def get_parameters(self):
-            return [val.cpu().numpy() for _, val in net.state_dict().items()]
+            # canonical (contiguous) layout, independent of the local memory format
+            return [val.cpu().contiguous().numpy() for _, val in net.state_dict().items()]
 
         def set_parameters_train(self, parameters, config):
             # obtain hyperparams and distribution
@@ -120,19 +136,39 @@ def main(device, client_id):
             state_dict = OrderedDict({k: torch.tensor(v) for k, v in params_dict})
             net.load_state_dict(state_dict, strict=True)
 
-        def fit(self, parameters, config):
-            self.set_parameters_train(parameters, config)
+        def fit(self, parameters, cfg):
+            fit_start = time.time()
+            self.set_parameters_train(parameters, cfg)
             net.drop_path_prob = 0
-            before_loss, _ = _test(net, test_data, device)
+            # mean loss per probe batch, s.t. gains do not scale with the size of the probe set (the whole-set losses stay summed as before)
+            before_loss, _ = _test(net, probe_data, device)
+            if config.PROBE_SIZE > 0:
+                before_loss /= len(probe_data)
             net.drop_path_prob = self.hyperparam_config['dropout']
-            for _ in range(EPOCHS):
-                train(net, train_data, self.writer, self.epoch, self.optim, device)
+            max_steps, stop_at = self._local_work(cfg.get('deadline', 0), fit_start)
+            steps = 0
+            train_start = time.time()
+            while steps < max_steps and (stop_at is None or steps < config.MIN_LOCAL_STEPS or time.time() < stop_at):
+                steps += train(net, train_data, self.writer, self.epoch, self.optim, device, max_steps - steps, stop_at)
+            self.throughput.update(time.time() - train_start, steps)
             net.drop_path_prob = 0
-            after_loss, _ = _test(net, test_data, device)
+            after_loss, _ = _test(net, probe_data, device)
+            if config.PROBE_SIZE > 0:
+                after_loss /= len(probe_data)
             model_params = self.get_parameters()
             rtpt.step()
             self.epoch += 1
-            return model_params, len(train_data), {'hidx': self.hidx, 'before': before_loss, 'after': after_loss}
+            # with a deadline, updates are weighted by the number of samples actually processed
+            num_examples = len(train_data) if stop_at is None else steps * config.BATCH_SIZE
+            return model_params, num_examples, {'hidx': self.hidx, 'before': before_loss, 'after': after_loss, 'probe': len(probe), 'steps': steps}
+
+        def _local_work(self, deadline, fit_start):
+            # choose the number of local steps s.t. fit finishes within deadline seconds (see feathers/hanf_client.py)
+            if deadline <= 0:
+                return EPOCHS * len(train_data), None
+            budget = deadline - 2 * (time.time() - fit_start)
+            max_steps = self.throughput.steps_within(budget, config.MIN_LOCAL_STEPS, config.MAX_LOCAL_EPOCHS * len(train_data))
+            return max_steps, time.time() + budget
 
         def evaluate(self, parameters, config):
             self.set_parameters_evaluate(parameters)
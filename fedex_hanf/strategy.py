@@ -67,6 +67,8 @@ class FedexStrategy(fl.server.strategy.FedAvg):
                                 around those for which p(configuration) > epsilon holds. Smaller beta leads to a more wide-spread distribution. Defaults to 1.
         """
         super().__init__(fraction_fit=fraction_fit, fraction_eval=fraction_eval, **args)
+        if self.on_fit_config_fn is None:
+            self.on_fit_config_fn = self.fit_config
         self.hyperparams = Hyperparameters(config.HYPERPARAM_CONFIG_NR)
         self.hyperparams.save(config.HYPERPARAM_FILE)
         log_hyper_params({'learning_rates': self.hyperparams})
@@ -217,8 +219,17 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         Returns:
             _type_: Gains
         """
+        # losses measured on small probe sets are noisier, weight them by their inverse variance (~ probe size)
+        probe_sizes = np.array([res.metrics.get('probe', 0) for _, res in results])
+        if np.all(probe_sizes > 0):
+            weights = weights * probe_sizes / np.sum(weights * probe_sizes)
         after_losses = [res.metrics['after'] for _, res in results]
         before_losses = [res.metrics['before'] for _, res in results]
+        steps = np.array([res.metrics.get('steps', 0) for _, res in results])
+        if np.all(steps > 0):
+            # normalize losses to the mean number of local steps if clients did different amounts of work
+            scale = steps.mean() / steps
+            after_losses = [b + s * (a - b) for a, b, s in zip(after_losses, before_losses, scale)]
         hidxs = [res.metrics['hidx'] for _, res in results]
         # compute (avg_before - avg_after)
         avg_gains = np.array([w * (a - b) for w, a, b in zip(weights, after_losses, before_losses)]).sum()
@@ -236,6 +247,15 @@ class FedexStrategy(fl.server.strategy.FedAvg):
         self.log_gain_hist.append(gains)
         return gains
     
+    def fit_config(self, rnd):
+        """
+        Configuration sent to the clients along with the parameters in each fit-round.
+        """
+        fit_config = {}
+        if config.ROUND_DEADLINE > 0:
+            fit_config['deadline'] = float(config.ROUND_DEADLINE)
+        return fit_config
+
     def update_distribution(self, gains, weights):
         """
         Update the distribution over the hyperparameter-search space.
@@ -1,13 +1,15 @@
+import contextlib
 import os, sys
 import numpy as np
 import torch
 import shutil
 import torchvision.transforms as transforms
 from torch.autograd import Variable
-from torch.utils.data import random_split, Subset
+from torch.utils.data import random_split, Subset, TensorDataset
 import torchvision
 import math
 import json
+import config
 
 class Loader:
 
@@ -215,10 +217,80 @@ def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
             val_subs_inds.append(indices)
     return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
 
+def memory_format():
+    """
+    Memory format of the conv-weights and input batches: channels-last (NHWC) if config.CHANNELS_LAST, else unchanged.
+    Parameters are always sent in the canonical (contiguous) layout, see get_parameters of the clients.
+    """
+    return torch.channels_last if config.CHANNELS_LAST else torch.preserve_format
+
+def autocast(device):
+    """
+    Context for the forward passes of training and evaluation: bfloat16 autocast if config.PRECISION == 'bf16',
+    no-op otherwise. Weights, gradients and batch-norm statistics (and thus all parameters sent) stay float32.
+    """
+    if config.PRECISION != 'bf16':
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('PRECISION = \'bf16\' needs torch >= 1.10 (installed: {})'.format(torch.__version__))
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()
 
+def get_targets(dataset):
+    """
+    Obtain the labels of a dataset (or of a Subset of it) as numpy-array without loading any samples.
+    """
+    if isinstance(dataset, Subset):
+        return get_targets(dataset.dataset)[np.asarray(dataset.indices)]
+    targets = dataset.y if hasattr(dataset, 'y') else dataset.targets
+    if isinstance(targets, torch.Tensor):
+        targets = targets.cpu().numpy()
+    return np.asarray(targets)
+
+def stratified_sample(targets, size, rng):
+    """
+    Draw a random sample of positions of size `size` whose label distribution matches the one of `targets`
+    (proportional allocation, remaining slots go to the labels with the largest fractional allocation).
+
+    Args:
+        targets (np.ndarray): Labels of the population
+        size (int): Sample size
+        rng (np.random.Generator): Random generator used for sampling
+
+    Returns:
+        np.ndarray: Sorted positions (w.r.t. targets) of the sampled elements
+    """
+    size = min(size, len(targets))
+    labels, counts = np.unique(targets, return_counts=True)
+    exact = size * counts / len(targets)
+    alloc = np.floor(exact).astype(int)
+    alloc[np.argsort(alloc - exact)[:size - alloc.sum()]] += 1
+    # random order within each label, labels in contiguous blocks
+    perm = rng.permutation(len(targets))
+    perm = perm[np.argsort(np.asarray(targets)[perm], kind='stable')]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.sort(np.concatenate([perm[s:s+a] for s, a in zip(starts, alloc)]))
+
+def build_probe_set(dataset, size, seed=0):
+    """
+    Materialize a fixed stratified subset of `dataset` as contiguous tensors. Used by clients to
+    measure their before/after gain losses on a small, fixed set instead of the whole validation set.
+
+    Args:
+        dataset (Dataset): (Subset of a) dataset to sample from
+        size (int): Size of the probe set
+        seed (int, optional): Seed of the sample. Defaults to 0.
+
+    Returns:
+        TensorDataset: Probe set
+    """
+    inds = stratified_sample(get_targets(dataset), size, np.random.default_rng(seed))
+    feats, labels = zip(*[dataset[int(i)] for i in inds])
+    return TensorDataset(torch.stack(feats).contiguous(), torch.as_tensor([int(l) for l in labels]))
+
 class AvgrageMeter(object):
 
   def __init__(self):
@@ -234,6 +306,28 @@ class AvgrageMeter(object):
     self.cnt += n
     self.avg = self.sum / self.cnt
 
+class ThroughputMeter(object):
+
+  def __init__(self, momentum=0.5):
+    self.momentum = momentum
+    self.sec_per_step = None
+
+  def update(self, seconds, steps):
+    if steps == 0:
+      return
+    sec_per_step = seconds / steps
+    if self.sec_per_step is None:
+      self.sec_per_step = sec_per_step
+    else:
+      self.sec_per_step = self.momentum * self.sec_per_step + (1 - self.momentum) * sec_per_step
+
+  def steps_within(self, budget, min_steps=1, max_steps=None):
+    """number of steps that fit into budget seconds, max_steps as long as the throughput is unknown"""
+    if self.sec_per_step is None:
+      return max_steps
+    steps = max(min_steps, int(budget / self.sec_per_step))
+    return steps if max_steps is None else min(steps, max_steps)
+
 class CrossEntropyLabelSmooth(torch.nn.Module):
 
   def __init__(self, num_classes, epsilon):
@@ -27,5 +27,9 @@ DATA_SKEW = 0.5 # skew of labels. 0 = no skew, 1 only some clients hold some lab
 # validation stage
 DROP_PATH_PROB = 0.2 # probability of dropping a path in cell, similar to dropout
 
+# runtime
+PRECISION = 'fp32' # 'fp32' or 'bf16' (bfloat16 autocast of forward passes, weights and parameters sent stay float32)
+CHANNELS_LAST = False # channels-last (NHWC) memory format of conv-networks and input batches, faster depthwise-convs on CPU
+
 DATASET_INDS_FILE = f'./hyperparam-logs/search_DARTS_{DATASET}_{CLIENT_NR}_{DATA_SKEW}.csv'
 HYPERPARAM_FILE = './hyperparam-logs/indices.json'
\ No newline at end of file
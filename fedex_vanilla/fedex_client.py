@@ -6,7 +6,7 @@ import flwr as fl
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from utils import get_dataset_loder
+from utils import get_dataset_loder, autocast, memory_format
 from fedex_model import FMNISTCNN, CIFARCNN
 from rtpt import RTPT
 import numpy as np
@@ -24,9 +24,10 @@ def train(net, trainloader, writer, epoch, optimizer, device):
     criterion = torch.nn.CrossEntropyLoss()
     running_loss = 0
     for i, (images, labels) in enumerate(trainloader):
-        images, labels = images.to(device), labels.to(device)
+        images, labels = images.to(device, memory_format=memory_format()), labels.to(device)
         optimizer.zero_grad()
-        logits = net(images)
+        with autocast(device):
+            logits = net(images).float()
         writer.add_histogram('logits', logits, i*epoch)
         loss = criterion(logits, labels)
         loss.backward()
@@ -44,8 +45,10 @@ def _test(net, testloader, device):
         for feats, labels in testloader:
             #feats = feats.type(torch.FloatTensor)
             #labels = labels.type(torch.LongTensor)
-            feats, labels = feats.to(device), labels.to(device)
-            preds = net(feats)
+            feats, labels = feats.to(device, memory_format=memory_format()), labels.to(device)
+            with autocast(device):
+                preds = net(feats)
+            preds = preds.float()
             loss += criterion(preds, labels).item()
             _, predicted = torch.max(preds.data, 1)
             total += labels.size(0)
@@ -66,7 +69,7 @@ def main(device, client_id):
         net = CIFARCNN(config.IN_CHANNELS, config.OUT_CHANNELS, config.CLASSES)
     elif config.DATASET == 'fmnist':
         net = FMNISTCNN()
-    net.to(device)
+    net.to(device, memory_format=memory_format())
 
     # Load data
     dataset_loader = get_dataset_loder(config.DATASET, config.CLIENT_NR, config.DATASET_INDS_FILE, config.DATA_SKEW)
@@ -89,7 +92,8 @@ def main(device, client_id):
             self.epoch = 1
 
         def get_parameters(self):
-            return [val.cpu().numpy() for _, val in net.state_dict().items()]
+            # canonical (contiguous) layout, independent of the local memory format
+            return [val.cpu().contiguous().numpy() for _, val in net.state_dict().items()]
 
         def set_parameters_train(self, parameters, config):
             # obtain hyperparams and distribution
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import numpy as np
 import torch
@@ -8,6 +9,7 @@ from torch.utils.data import random_split, Subset
 import torchvision
 import math
 import json
+import config
 
 class FashionMNISTLoader:
 
@@ -226,6 +228,24 @@ def partition_skewed(train_set, val_set, partitions, randomise=True, skew=0):
             val_subs_inds.append(indices)
     return train_partitions, val_partitions, test_set, train_subs_inds, val_subs_inds, test_subs_inds
 
+def memory_format():
+    """
+    Memory format of the conv-weights and input batches: channels-last (NHWC) if config.CHANNELS_LAST, else unchanged.
+    Parameters are always sent in the canonical (contiguous) layout, see get_parameters of the clients.
+    """
+    return torch.channels_last if config.CHANNELS_LAST else torch.preserve_format
+
+def autocast(device):
+    """
+    Context for the forward passes of training and evaluation: bfloat16 autocast if config.PRECISION == 'bf16',
+    no-op otherwise. Weights, gradients and batch-norm statistics (and thus all parameters sent) stay float32.
+    """
+    if config.PRECISION != 'bf16':
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('PRECISION = \'bf16\' needs torch >= 1.10 (installed: {})'.format(torch.__version__))
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
+
 def discounted_mean(series, gamma=1.0):
     weight = gamma ** np.flip(np.arange(len(series)), axis=0)
     return np.inner(series, weight) / weight.sum()